@@ -0,0 +1,192 @@
+# Copyright 2019 Extreme Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per host admission control shared by all the processes on a node.
+
+Devices only have a handful of VTY lines so when a workflow fans out, executions which can't
+get one fail or stall until they time out. HostSemaphore limits the number of concurrent
+sessions to a host across all the actionrunner processes using lock files.
+"""
+
+from __future__ import absolute_import
+
+import os
+import time
+import uuid
+import errno
+import fcntl
+import hashlib
+import tempfile
+
+__all__ = [
+    'HostSemaphore'
+]
+
+LOCK_DIR = os.path.join(tempfile.gettempdir(), 'st2-expect-runner-locks')
+
+# How often waiters check whether it's their turn
+POLL_INTERVAL = 0.1
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _try_lock(fd):
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+
+    return True
+
+
+class HostSemaphore(object):
+    """
+    Cross process counting semaphore which allows up to max_sessions slots per host to be held.
+
+    Every slot is a lock file held using flock() so slots held by a process which died are
+    released by the kernel. Waiters queue up in arrival order: each waiter holds a lock on its
+    own ticket file in the queue directory of the host and only the oldest live ticket is allowed
+    to take a free slot, so newcomers can't jump ahead of executions which are already waiting.
+    """
+
+    def __init__(self, host, max_sessions, lock_dir=None):
+        self._max_sessions = max_sessions
+        self._dir = os.path.join(lock_dir or LOCK_DIR,
+                                 hashlib.sha1(host.encode('utf-8')).hexdigest())
+        self._queue_dir = os.path.join(self._dir, 'queue')
+        self._slot_fds = []
+
+    @property
+    def slots(self):
+        """
+        Number of slots currently held.
+        """
+        return len(self._slot_fds)
+
+    def acquire(self, timeout, count=1):
+        """
+        Wait for up to timeout seconds until count more slots are free and take them all at
+        once. Returns True if the slots were acquired.
+        """
+        _makedirs(self._queue_dir)
+
+        deadline = time.time() + timeout
+        ticket_path, ticket_fd = self._enqueue()
+
+        try:
+            while True:
+                if self._is_first(ticket_path) and self._take_slots(count):
+                    return True
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+
+                time.sleep(min(POLL_INTERVAL, remaining))
+        finally:
+            os.close(ticket_fd)
+            self._unlink(ticket_path)
+
+    def release(self, count=None):
+        """
+        Release count of the held slots, all of them by default.
+        """
+        count = len(self._slot_fds) if count is None else min(count, len(self._slot_fds))
+
+        for _ in range(count):
+            fd = self._slot_fds.pop()
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _enqueue(self):
+        # Tickets sort in arrival order. They are locked before being moved into the queue so
+        # other waiters never see an unlocked (i.e. abandoned) ticket of a live waiter.
+        name = '%020d-%d-%s' % (int(time.time() * 1000000), os.getpid(), uuid.uuid4().hex[:8])
+        temp_path = os.path.join(self._dir, '.%s' % (name))
+        ticket_path = os.path.join(self._queue_dir, name)
+
+        fd = os.open(temp_path, os.O_CREAT | os.O_RDWR, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(temp_path, ticket_path)
+
+        return ticket_path, fd
+
+    def _is_first(self, ticket_path):
+        ticket = os.path.basename(ticket_path)
+
+        for name in sorted(os.listdir(self._queue_dir)):
+            if name >= ticket:
+                return True
+
+            path = os.path.join(self._queue_dir, name)
+
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except OSError:
+                # Ticket was removed in the meantime
+                continue
+
+            try:
+                if not _try_lock(fd):
+                    return False
+
+                # Nobody holds the ticket, its waiter died without cleaning it up
+                self._unlink(path)
+            finally:
+                os.close(fd)
+
+        return True
+
+    def _take_slots(self, count):
+        taken = []
+
+        for index in range(self._max_sessions):
+            if len(taken) == count:
+                break
+
+            # Slots held by this instance are locked through another file descriptor, so they
+            # can't be locked again here
+            path = os.path.join(self._dir, 'slot-%d' % (index))
+            fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+
+            if _try_lock(fd):
+                taken.append(fd)
+            else:
+                os.close(fd)
+
+        if len(taken) < count:
+            # Not enough free slots, don't hold on to some of them while waiting
+            for fd in taken:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+            return False
+
+        self._slot_fds.extend(taken)
+        return True
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
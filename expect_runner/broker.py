@@ -0,0 +1,327 @@
+# Copyright 2019 Extreme Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Long-lived session broker which owns the device sessions for all the actionrunner processes on
+a node.
+
+Every actionrunner process would otherwise open its own sessions to the same devices, which
+quickly exhausts the (often 5-16) VTY lines a device has. The broker keeps warm sessions per
+host / credentials, leases them to ExpectRunner executions using the "broker" handler (see
+BrokerHandler for the protocol) and caps the number of sessions it opens per host.
+"""
+
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import socket
+import logging
+import argparse
+import threading
+import collections
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from expect_runner import expect_runner
+
+__all__ = [
+    'SessionBroker',
+    'main'
+]
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_MAX_SESSIONS_PER_HOST = 4
+
+DEFAULT_IDLE_TIMEOUT = 300
+
+# How often idle sessions are checked for expiry
+REAP_INTERVAL = 10
+
+# Handler options clients can pass in the "options" of an "open" request
+HANDLER_OPTIONS = ['port', 'transfer_profile', 'compress']
+
+
+class _Lease(object):
+    __slots__ = ('key', 'host', 'session')
+
+    def __init__(self, key, host, session):
+        self.key = key
+        self.host = host
+        self.session = session
+
+
+class SessionBroker(object):
+    def __init__(self, socket_path=expect_runner.BROKER_SOCKET,
+                 max_sessions_per_host=DEFAULT_MAX_SESSIONS_PER_HOST,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self._socket_path = socket_path
+        self._max_sessions_per_host = max_sessions_per_host
+        self._idle_timeout = idle_timeout
+
+        self._lock = threading.Condition()
+        # Idle sessions by session key
+        self._idle = {}
+        # Number of open (idle and leased) sessions by host
+        self._open = collections.Counter()
+
+        self._server = None
+
+    def serve_forever(self):
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+
+        self._server = _BrokerServer(self._socket_path, _BrokerRequestHandler)
+        self._server.broker = self
+        os.chmod(self._socket_path, 0o660)
+
+        reaper = threading.Thread(target=self._reap)
+        reaper.daemon = True
+        reaper.start()
+
+        LOG.info('Session broker listening on %s', self._socket_path)
+        self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+        with self._lock:
+            sessions = [session for sessions in self._idle.values() for session in sessions]
+            self._idle.clear()
+
+        for session in sessions:
+            expect_runner._terminate_session(session)
+
+    def dispatch(self, request, lease):
+        """
+        Handle a single request. Returns a (response, lease) tuple where lease is the session
+        leased by the connection after the request.
+        """
+        op = request.get('op')
+
+        try:
+            expect_runner._set_thread_timer(request.get('timeout', 0))
+
+            if op == 'open':
+                if lease:
+                    raise expect_runner.BrokerError('Connection already holds a session')
+                lease = self.acquire(request)
+                return self._response(state=self._get_state(lease.session)), lease
+            elif op == 'send':
+                if not lease:
+                    raise expect_runner.BrokerError('Connection doesn\'t hold a session')
+                output = lease.session.send(request['cmd'], request['expect'],
+                                            secret=request.get('secret', False))
+                return self._response(output=output), lease
+            elif op == 'release':
+                if not lease:
+                    raise expect_runner.BrokerError('Connection doesn\'t hold a session')
+                for name, value in request.get('state', {}).items():
+                    setattr(lease.session.state, name, value)
+                self.release(lease, request.get('healthy', False))
+                return self._response(), None
+            else:
+                raise expect_runner.BrokerError('Unknown operation "%s"' % (op))
+        except (expect_runner.TimeoutError, socket.timeout) as e:
+            return self._response('timeout', error='%s' % (e),
+                                  output=getattr(e, 'output', '')), self._drop(lease)
+        except Exception as e:
+            LOG.debug('Failed to handle "%s" request: %s', op, e)
+            return self._response('error', error='%s' % (e)), self._drop(lease)
+
+    def acquire(self, request):
+        handler_name = request.get('handler') or expect_runner.HANDLER
+        handler = expect_runner.HANDLERS.get(handler_name)
+
+        if not handler or not handler.poolable:
+            raise expect_runner.BrokerError('Unsupported handler "%s"' % (handler_name))
+
+        options = dict((name, value) for name, value in (request.get('options') or {}).items()
+                       if value is not None)
+        unsupported = set(options.keys()) - set(HANDLER_OPTIONS)
+        if unsupported:
+            raise expect_runner.BrokerError('Unsupported handler options: %s' %
+                                            (', '.join(sorted(unsupported))))
+
+        host = request['host']
+        key = expect_runner._session_key(handler_name, host, request.get('username'),
+                                         request.get('password'), options)
+        deadline = time.time() + request.get('timeout', 0)
+
+        with self._lock:
+            while True:
+                self._expire_idle()
+
+                sessions = self._idle.get(key, [])
+                while sessions:
+                    session = sessions.pop()
+                    if session.is_alive():
+                        LOG.debug('Leasing warm session to %s', host)
+                        return _Lease(key, host, session)
+                    self._close(host, session)
+
+                if self._open[host] < self._max_sessions_per_host:
+                    self._open[host] += 1
+                    break
+
+                # At capacity, make room by closing an idle session using other credentials
+                if self._evict_idle(host):
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise expect_runner.TimeoutError(
+                        'Timed out waiting for a free session to %s' % (host))
+                self._lock.wait(min(remaining, 1))
+
+        LOG.debug('Opening new session to %s', host)
+
+        try:
+            session = handler(host, request.get('username'), request.get('password'),
+                              request.get('timeout', 0), **options)
+        except Exception:
+            with self._lock:
+                self._open[host] -= 1
+                self._lock.notify()
+            raise
+
+        return _Lease(key, host, session)
+
+    def release(self, lease, healthy):
+        with self._lock:
+            if healthy and lease.session.is_alive():
+                lease.session.state.expires_at = time.time() + self._idle_timeout
+                self._idle.setdefault(lease.key, []).append(lease.session)
+            else:
+                self._close(lease.host, lease.session)
+
+            self._lock.notify()
+
+    def _drop(self, lease):
+        if lease:
+            self.release(lease, False)
+
+        return None
+
+    def _close(self, host, session):
+        self._open[host] -= 1
+        expect_runner._terminate_session(session)
+
+    def _evict_idle(self, host):
+        for key, sessions in self._idle.items():
+            if key[1] == host and sessions:
+                self._close(host, sessions.pop(0))
+                return True
+
+        return False
+
+    def _expire_idle(self):
+        now = time.time()
+
+        for key in list(self._idle.keys()):
+            sessions = self._idle[key]
+            for session in [s for s in sessions if s.state.expires_at < now]:
+                LOG.debug('Closing idle session to %s', key[1])
+                sessions.remove(session)
+                self._close(key[1], session)
+
+            if not sessions:
+                del self._idle[key]
+
+    def _reap(self):
+        while True:
+            time.sleep(REAP_INTERVAL)
+            with self._lock:
+                self._expire_idle()
+                self._lock.notify_all()
+
+    @staticmethod
+    def _get_state(session):
+        return {
+            'init_digest': session.state.init_digest,
+            'init_output': session.state.init_output,
+            'privileged': session.state.privileged
+        }
+
+    @staticmethod
+    def _response(status='ok', **kwargs):
+        kwargs['status'] = status
+        return kwargs
+
+
+class _BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        lease = None
+
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError as e:
+                    response = {'status': 'error', 'error': 'Invalid request: %s' % (e)}
+                else:
+                    response, lease = self.server.broker.dispatch(request, lease)
+
+                self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+                self.wfile.flush()
+        finally:
+            # Client went away without releasing, session is in an unknown state
+            if lease:
+                self.server.broker.release(lease, False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='StackStorm expect runner session broker')
+    parser.add_argument('--socket', default=expect_runner.BROKER_SOCKET,
+                        help='Path of the Unix domain socket to listen on.')
+    parser.add_argument('--max-sessions-per-host', type=int,
+                        default=DEFAULT_MAX_SESSIONS_PER_HOST,
+                        help='Maximum number of sessions opened to a single host.')
+    parser.add_argument('--idle-timeout', type=int, default=DEFAULT_IDLE_TIMEOUT,
+                        help='Number of seconds an unused session is kept open.')
+    parser.add_argument('--log-level', default='INFO', help='Log level.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(),
+                        format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+
+    broker = SessionBroker(socket_path=args.socket,
+                           max_sessions_per_host=args.max_sessions_per_host,
+                           idle_timeout=args.idle_timeout)
+
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.shutdown()
+
+
+if __name__ == '__main__':
+    main()
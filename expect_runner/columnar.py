@@ -0,0 +1,141 @@
+# Copyright 2019 Extreme Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact columnar encoding of parsed results.
+
+Tabular grammars produce lists of thousands of records repeating the same keys. to_columnar()
+turns every such list into a single object listing the keys once:
+
+    {
+        "__columnar__": 1,
+        "columns": ["name", "age"],
+        "rows": [["Emma", "22"], ["Kevin", "194"]]
+    }
+
+With intern_strings, columns holding only strings with repeated values store indexes into a
+shared "strings" table instead and are listed in "interned". from_columnar() expands the
+encoded data back to records.
+"""
+
+from __future__ import absolute_import
+
+__all__ = [
+    'to_columnar',
+    'from_columnar'
+]
+
+MARKER = '__columnar__'
+
+VERSION = 1
+
+try:
+    STRING_TYPES = (str, unicode)  # noqa: F821
+except NameError:
+    STRING_TYPES = (str,)
+
+
+def _is_table(value, min_rows):
+    if len(value) < min_rows or not all(isinstance(item, dict) for item in value):
+        return False
+
+    keys = set(value[0].keys())
+    return all(set(item.keys()) == keys for item in value[1:])
+
+
+def _encode_table(records, intern_strings, min_rows):
+    columns = list(records[0].keys())
+    rows = [[to_columnar(record[column], intern_strings, min_rows) for column in columns]
+            for record in records]
+
+    table = {
+        MARKER: VERSION,
+        'columns': columns,
+        'rows': rows
+    }
+
+    if not intern_strings:
+        return table
+
+    strings = []
+    string_indexes = {}
+    interned = []
+
+    for index, column in enumerate(columns):
+        values = [row[index] for row in rows]
+
+        if not all(isinstance(value, STRING_TYPES) for value in values) or \
+                len(set(values)) == len(values):
+            continue
+
+        interned.append(column)
+        for row in rows:
+            if row[index] not in string_indexes:
+                string_indexes[row[index]] = len(strings)
+                strings.append(row[index])
+            row[index] = string_indexes[row[index]]
+
+    if interned:
+        table['strings'] = strings
+        table['interned'] = interned
+
+    return table
+
+
+def to_columnar(value, intern_strings=False, min_rows=2):
+    """
+    Encode every list of at least min_rows records (dicts) which all have the same keys found
+    in value (recursively) in the columnar format.
+    """
+    if isinstance(value, list):
+        if _is_table(value, min_rows):
+            return _encode_table(value, intern_strings, min_rows)
+        return [to_columnar(item, intern_strings, min_rows) for item in value]
+    elif isinstance(value, dict):
+        return dict((key, to_columnar(item, intern_strings, min_rows))
+                    for key, item in value.items())
+
+    return value
+
+
+def _is_encoded_table(value):
+    return MARKER in value and 'columns' in value and 'rows' in value
+
+
+def from_columnar(value):
+    """
+    Expand data encoded by to_columnar() back to lists of records.
+    """
+    if isinstance(value, list):
+        return [from_columnar(item) for item in value]
+    elif isinstance(value, dict):
+        if not _is_encoded_table(value):
+            return dict((key, from_columnar(item)) for key, item in value.items())
+
+        if value[MARKER] != VERSION:
+            raise ValueError('Unsupported columnar format version: %s' % (value[MARKER]))
+
+        strings = value.get('strings', [])
+        interned = set(value.get('interned', []))
+
+        records = []
+        for row in value['rows']:
+            record = {}
+            for column, cell in zip(value['columns'], row):
+                record[column] = strings[cell] if column in interned else from_columnar(cell)
+            records.append(record)
+
+        return records
+
+    return value
@@ -12,15 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import pty
 import uuid
 import time
+import errno
+import fcntl
+import codecs
+import select
 import socket
+import struct
+import signal
+import termios
 import re
 import json
 import copy
+import hashlib
+import threading
+import subprocess
+import collections
 
-import tatsu
-import paramiko
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 from st2common.runners.base import ActionRunner
 from st2common.runners.base import get_metadata as get_runner_metadata
@@ -29,6 +44,9 @@ from st2common.constants.action import LIVEACTION_STATUS_SUCCEEDED
 from st2common.constants.action import LIVEACTION_STATUS_FAILED
 from st2common.constants.action import LIVEACTION_STATUS_TIMED_OUT
 
+from expect_runner.admission import HostSemaphore
+from expect_runner.columnar import to_columnar
+
 LOG = logging.getLogger(__name__)
 
 HANDLER = 'ssh'
@@ -41,25 +59,417 @@ TIMEOUT = 60
 
 SLEEP_TIMER = 0.1
 
+# Default path of the session broker Unix socket (see expect_runner/broker.py)
+BROKER_SOCKET = '/var/run/st2/expect-broker.sock'
+
+# Extra time given to the session broker to report a timeout itself before the connection to it
+# is considered timed out
+BROKER_GRACE_PERIOD = 5
+
+# SSH transport and shell settings selected using the "transfer_profile" runner parameter.
+# "bulk" is meant for large outputs (full configs, log dumps): it uses bigger reads, which matter
+# most since every read has a fixed cost, a large window and packet size,
+# which help on high latency links, and a wide terminal so devices don't wrap long lines.
+# None means the paramiko / module default.
+TRANSFER_PROFILES = {
+    'default': {
+        'window_size': None,
+        'max_packet_size': None,
+        'recv_size': 1024,
+        'poll_interval': None,
+        'term_width': 200,
+        'term_height': 200
+    },
+    'bulk': {
+        'window_size': 16 * 1024 * 1024,
+        'max_packet_size': 128 * 1024,
+        'recv_size': 64 * 1024,
+        'poll_interval': None,
+        'term_width': 1024,
+        'term_height': 200
+    }
+}
+
+# Command spawned by the "pty" handler when no "pty_command" is provided. It uses OpenSSH
+# connection multiplexing so only the first execution against a host pays for the login.
+# Host keys must already be in the known_hosts file of the actionrunner user, ssh fails right
+# away for unknown hosts instead of waiting at the yes/no prompt until the timeout.
+# {host}, {port} and {username} are replaced with the runner parameters.
+PTY_COMMAND = [
+    'ssh', '-tt',
+    '-o', 'StrictHostKeyChecking=yes',
+    '-o', 'ControlMaster=auto',
+    '-o', 'ControlPath=~/.ssh/st2-expect-%r@%h:%p',
+    '-o', 'ControlPersist=600',
+    '-p', '{port}',
+    '-l', '{username}',
+    '{host}'
+]
+
+# Password prompt answered with the "password" parameter when the pty command asks for it
+PTY_PASSWORD_PROMPT = r'[Pp]assword:\s*$'
+
+# Supported values of the "result_format" runner parameter
+RESULT_FORMATS = ['default', 'columnar']
+
+# Format version of the checkpoints returned by timed out executions
+CHECKPOINT_VERSION = 1
+
+# Default number of commands run at once in "exec" mode
+EXEC_CONCURRENCY = 4
+
+# Maximum number of compiled command plans kept in memory
+PLAN_CACHE_SIZE = 256
+
+# Maximum number of expects with a known match length kept in memory
+EXPECT_WIDTHS_CACHE_SIZE = 1024
+
+# Maximum number of idle sessions kept in the in-process session pool per pool key and how
+# often (in seconds) idle sessions are checked for expiry
+SESSION_POOL_SIZE = 4
+SESSION_POOL_REAP_INTERVAL = 10
+
+# Output streamed to the execution output store is buffered until either this many characters
+# have been received or this many seconds have passed since the last write
+STREAM_BATCH_SIZE = 4096
+STREAM_BATCH_INTERVAL = 1.0
+
+# Command used to enter privileged mode and the prompt it answers with when a
+# "privilege_password" is provided. Can be overridden using the runner config.
+PRIVILEGE_CMD = 'enable'
+PRIVILEGE_EXPECT = r'[Pp]assword:'
+
+# NOTE: tatsu and paramiko (which pulls in the whole cryptography stack) are expensive to
+# import. They are only needed once a grammar is parsed or a handler connects, so they are
+# imported on first use instead of at module import time. This keeps runner registration,
+# get_metadata() and actionrunner worker startup cheap.
+tatsu = None
+paramiko = None
+
+
+_PLAN_CACHE = collections.OrderedDict()
+
+# Maximum match length of expects by (pattern, flags), see _get_expect_width()
+_EXPECT_WIDTHS = {}
+_PLAN_CACHE_LOCK = threading.Lock()
+
+# Idle sessions kept alive between executions for actions with "persistent_session" enabled,
+# keyed by (handler, host, username, password digest, handler options digest)
+_SESSION_POOL = {}
+_SESSION_POOL_LOCK = threading.Lock()
+_SESSION_REAPER = None
+
+# Per thread ENTRY_TIME / TIMEOUT overrides. Used by threads which serve many executions at once
+# (e.g. session broker workers) and thus can't rely on the module level values.
+_THREAD_TIMER = threading.local()
+
 
 class TimeoutError(Exception):
+    def __init__(self, message, output=''):
+        super(TimeoutError, self).__init__(message)
+        # Output received before the timeout was reached
+        self.output = output
+
+
+class BrokerError(Exception):
     pass
 
 
+def _set_thread_timer(timeout):
+    _THREAD_TIMER.entry_time = time.time()
+    _THREAD_TIMER.timeout = timeout
+
+
+def _get_timeout():
+    return getattr(_THREAD_TIMER, 'timeout', TIMEOUT)
+
+
 def _elapsed_time():
-    return time.time() - ENTRY_TIME
+    return time.time() - getattr(_THREAD_TIMER, 'entry_time', ENTRY_TIME)
 
 
 def _check_timer():
-    return _elapsed_time() <= TIMEOUT
+    return _elapsed_time() <= _get_timeout()
 
 
 def _remaining_time():
-    return TIMEOUT - _elapsed_time()
+    return _get_timeout() - _elapsed_time()
+
+
+def _get_tatsu():
+    global tatsu
+    if tatsu is None:
+        import tatsu
+    return tatsu
+
+
+def _get_paramiko():
+    global paramiko
+    if paramiko is None:
+        import paramiko
+    return paramiko
+
+
+def _expect_return(expect, output, pos=0):
+    return re.compile(expect).search(output, pos) is not None
+
+
+def _has_lookahead(items):
+    for op, av in items:
+        if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT) and av[0] == 1:
+            return True
+
+        values = list(av) if isinstance(av, (list, tuple)) else [av]
+        while values:
+            value = values.pop()
+            if isinstance(value, (list, tuple)):
+                values.extend(value)
+            elif isinstance(value, sre_parse.SubPattern) and _has_lookahead(value):
+                return True
+
+    return False
+
+
+def _get_expect_width(expect):
+    """
+    Maximum length of a match of the expect or None if it's unbounded (or the expect looks
+    ahead, which can't be bounded either).
+    """
+    expect = re.compile(expect)
+    key = (expect.pattern, expect.flags)
+
+    if key not in _EXPECT_WIDTHS:
+        try:
+            parsed = sre_parse.parse(expect.pattern, expect.flags)
+            width = parsed.getwidth()[1]
+            if width >= sre_parse.MAXREPEAT - 1 or _has_lookahead(parsed):
+                width = None
+        except Exception:
+            width = None
+
+        if len(_EXPECT_WIDTHS) >= EXPECT_WIDTHS_CACHE_SIZE:
+            _EXPECT_WIDTHS.clear()
+        _EXPECT_WIDTHS[key] = width
+
+    return _EXPECT_WIDTHS[key]
+
+
+def _expect_search_pos(expect, output, received):
+    """
+    Position to search for the expect from after received characters were appended to output,
+    which was already searched before.
+
+    Any match which ends 2 characters ($, \b look at up to 2 characters around a position) or
+    more before the new data would have been found by the previous search. So a new match of
+    an expect with a bounded width has to start within its width before that. Expects with an
+    unbounded width (e.g. ".*") are searched for in the whole output.
+    """
+    width = _get_expect_width(expect)
+
+    if width is None:
+        return 0
+
+    return max(len(output) - received - width - 2, 0)
+
+
+def _plan_digest(cmds, default_expect):
+    try:
+        serialized = json.dumps([cmds, default_expect], sort_keys=True)
+    except (TypeError, ValueError):
+        # Not JSON serializable, plan can't be cached
+        return None
+
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+def _compile_step(cmd_tuple, default_expect):
+    if isinstance(cmd_tuple, list) and len(cmd_tuple) == 2:
+        cmd, expect = cmd_tuple
+    elif isinstance(cmd_tuple, list) and len(cmd_tuple) == 1:
+        cmd, expect = cmd_tuple[0], default_expect
+    elif isinstance(cmd_tuple, str):
+        cmd, expect = cmd_tuple, default_expect
+    elif isinstance(cmd_tuple, dict):
+        cmd, expect = cmd_tuple['cmd'], cmd_tuple.get('expect', default_expect)
+    else:
+        raise ValueError("Command error. Entry wasn't proper type (list, dict or string)"
+                         " or list was of incorrect length. %s" % (cmd_tuple))
+
+    if not cmd and not expect:
+        raise ValueError("Expect and command cannot both be NoneType.")
+
+    return CommandStep(cmd, re.compile(expect) if expect else None)
+
+
+def compile_plan(cmds, default_expect=None):
+    """
+    Validate and normalize a list of command entries into a CommandPlan.
+
+    Entries can be strings, ``[cmd]`` / ``[cmd, expect]`` lists or ``{'cmd': ..., 'expect': ...}``
+    dictionaries. Plans are cached by content so repeated executions of the same action skip
+    validation and regex compilation. The passed in ``cmds`` are never modified.
+    """
+    if not isinstance(cmds, list):
+        raise ValueError("Expected list, got %s which is of type %s" % (cmds,
+                                                                        type(cmds).__name__))
+
+    digest = _plan_digest(cmds, default_expect)
+
+    if digest is not None:
+        with _PLAN_CACHE_LOCK:
+            plan = _PLAN_CACHE.pop(digest, None)
+            if plan is not None:
+                # Re-insert so the most recently used plans are evicted last
+                _PLAN_CACHE[digest] = plan
+                return plan
+
+    plan = CommandPlan(digest, [_compile_step(cmd_tuple, default_expect) for cmd_tuple in cmds])
+
+    if digest is not None:
+        with _PLAN_CACHE_LOCK:
+            _PLAN_CACHE[digest] = plan
+            while len(_PLAN_CACHE) > PLAN_CACHE_SIZE:
+                _PLAN_CACHE.popitem(last=False)
+
+    return plan
+
+
+def _session_key(handler_name, host, username, password, options=None):
+    """
+    Sessions are only interchangeable if they were opened by the same handler with the same
+    credentials and handler options (port, transfer profile, local command, ...).
+    """
+    password_digest = hashlib.sha256((password or '').encode('utf-8')).hexdigest()
+    options_digest = hashlib.sha1(json.dumps(options or {}, sort_keys=True)
+                                  .encode('utf-8')).hexdigest()
+    return (handler_name, host, username, password_digest, options_digest)
+
+
+def _terminate_session(session):
+    try:
+        session.terminate()
+    except Exception as e:
+        LOG.debug('Failed to terminate session: %s', e)
+
+    if session.admission:
+        session.admission.release()
+        session.admission = None
+
+
+def _expire_sessions():
+    """
+    Remove the expired sessions from the pool and return them. Must be called with
+    _SESSION_POOL_LOCK held.
+    """
+    now = time.time()
+    expired = []
 
+    for pool_key in list(_SESSION_POOL.keys()):
+        sessions = _SESSION_POOL[pool_key]
+        expired.extend([s for s in sessions if s.state.expires_at < now])
+        sessions[:] = [s for s in sessions if s.state.expires_at >= now]
 
-def _expect_return(expect, output):
-    return re.search(expect, output) is not None
+        if not sessions:
+            del _SESSION_POOL[pool_key]
+
+    return expired
+
+
+def _terminate_sessions(sessions, reason):
+    for session in sessions:
+        LOG.debug('Terminating %s session', reason)
+        _terminate_session(session)
+
+
+def _checkout_session(key):
+    """
+    Return a live idle session for the provided key (removing it from the pool) or None.
+    Expired sessions for all keys are terminated along the way.
+    """
+    session = None
+
+    with _SESSION_POOL_LOCK:
+        expired = _expire_sessions()
+        sessions = _SESSION_POOL.get(key, [])
+
+        while sessions and session is None:
+            candidate = sessions.pop()
+            if candidate.is_alive():
+                session = candidate
+            else:
+                expired.append(candidate)
+
+        if key in _SESSION_POOL and not sessions:
+            del _SESSION_POOL[key]
+
+    _terminate_sessions(expired, 'expired or dead')
+
+    return session
+
+
+def _evict_host_sessions(host):
+    """
+    Remove all the idle sessions to the host from the pool and return them.
+    """
+    evicted = []
+
+    with _SESSION_POOL_LOCK:
+        for pool_key in [k for k in _SESSION_POOL.keys() if k[1] == host]:
+            evicted.extend(_SESSION_POOL.pop(pool_key))
+
+    return evicted
+
+
+def _checkin_session(key, session, idle_timeout):
+    """
+    Return a session to the pool for up to idle_timeout seconds. Only the SESSION_POOL_SIZE
+    most recently used sessions are kept per key, older ones are terminated.
+    """
+    session.state.expires_at = time.time() + idle_timeout
+
+    with _SESSION_POOL_LOCK:
+        sessions = _SESSION_POOL.setdefault(key, [])
+        sessions.append(session)
+        evicted = sessions[:-SESSION_POOL_SIZE]
+        del sessions[:-SESSION_POOL_SIZE]
+
+    _terminate_sessions(evicted, 'surplus idle')
+    _start_session_reaper()
+
+
+def _reap_sessions():
+    while True:
+        time.sleep(SESSION_POOL_REAP_INTERVAL)
+
+        with _SESSION_POOL_LOCK:
+            expired = _expire_sessions()
+
+        _terminate_sessions(expired, 'expired')
+
+
+def _start_session_reaper():
+    """
+    Start the thread which terminates expired idle sessions, so they don't hold connections
+    (and device VTY lines) open when no other persistent session execution comes along.
+    """
+    global _SESSION_REAPER
+
+    with _SESSION_POOL_LOCK:
+        if _SESSION_REAPER is not None:
+            return
+
+        _SESSION_REAPER = threading.Thread(target=_reap_sessions)
+        _SESSION_REAPER.daemon = True
+        _SESSION_REAPER.start()
+
+
+def _is_stream_output_enabled():
+    from oslo_config import cfg
+
+    try:
+        return cfg.CONF.actionrunner.stream_output
+    except (cfg.NoSuchOptError, cfg.NoSuchGroupError):
+        return False
 
 
 def get_runner(config=None):
@@ -81,50 +491,418 @@ class ExpectRunner(ActionRunner):
         }
         self._config.update(config)
 
+        self._shell = None
+        self._shell_released = False
+        self._session_key = None
+        self._streamer = None
+        self._admission = None
+        self._admission_slots = 0
+        self._admission_wait = None
+        self._plans_digest = None
+        self._step_outputs = None
+        self._exec_commands = None
+        self._exec_results = None
+        self._unfinished_outputs = {}
+
     def _parse(self, output):
-        model = tatsu.compile(self._grammar)
+        model = _get_tatsu().compile(self._grammar)
         parsed_output = model.parse(output, start=self._entry)
         LOG.info('Parsed output: %s', parsed_output)
 
         return parsed_output
 
-    def _get_shell_output(self, cmds, default_expect):
-        output = ''
+    def _get_shell_output(self, plan, shell=None, group=None):
+        """
+        Run the steps of the plan and return their merged output. For the plan of a command
+        group (group is its index) the output of every finished step is recorded for the
+        checkpoint, steps which already have an output there are skipped and the output received
+        for a step which timed out is kept for the partial output.
+        """
+        shell = shell or self._shell
+        step_outputs = [] if group is None else self._step_outputs[group]
 
-        if not isinstance(cmds, list):
-            raise ValueError("Expected list, got %s which is of type %s" % (cmds,
-                                                                            type(cmds).__name__))
-
-        for cmd_tuple in cmds:
-            LOG.debug("expect runner cmds: %s", cmd_tuple)
-            if isinstance(cmd_tuple, list) and len(cmd_tuple) == 2:
-                cmd = cmd_tuple.pop(0)
-                expect = cmd_tuple.pop(0)
-            elif isinstance(cmd_tuple, list) and len(cmd_tuple) == 1:
-                cmd = cmd_tuple.pop(0)
-                expect = default_expect
-            elif isinstance(cmd_tuple, str):
-                cmd = cmd_tuple
-                expect = default_expect
-            elif isinstance(cmd_tuple, dict):
-                cmd = cmd_tuple['cmd']
-                expect = cmd_tuple.get('expect', default_expect)
-            else:
-                raise ValueError("Command error. Entry wasn't proper type (list, dict or string)"
-                                 " or list was of incorrect length. %s" % (cmd_tuple))
+        for step in plan.steps[len(step_outputs):]:
+            LOG.debug("Dispatching command: %s, %s", step.cmd, step.expect)
 
-            LOG.debug("Dispatching command: %s, %s", cmd, expect)
+            try:
+                result = shell.send(step.cmd, step.expect)
+            except TimeoutError as e:
+                if group is not None:
+                    self._unfinished_outputs[group] = e.output
+                raise
 
-            result = self._shell.send(cmd, expect)
+            step_outputs.append(result if result else '')
 
-            output += result if result else ''
+        return ''.join(step_outputs)
 
-        return output
+    def _run_group(self, index, init_plan, plan, outputs, errors):
+        channel = None
+
+        try:
+            channel = self._shell.open_channel()
+            channel.output_callback = self._shell.output_callback
+            self._init_shell(init_plan, channel)
+            outputs[index] = self._get_shell_output(plan, channel, index)
+            channel.terminate()
+        except Exception as e:
+            LOG.debug("Command group %s failed: %s", index, e)
+            errors[index] = e
+            if channel:
+                _terminate_session(channel)
+
+    def _get_exec_commands(self, plans):
+        commands = []
+        for plan in plans:
+            for step in plan.steps:
+                if not step.cmd:
+                    raise ValueError('Every entry needs a command in exec mode, got: %s' % (step))
+                commands.append(step.cmd)
+
+        return commands
+
+    def _get_exec_output(self):
+        """
+        Run all the commands which haven't finished yet (see resume_from) on their own exec
+        channels. Returns the merged stdout of the commands and the per command results.
+        """
+        if not hasattr(self._shell, 'exec_commands'):
+            raise ValueError('exec mode is not supported by the "%s" handler' % (self._handler))
+
+        pending = [index for index, result in enumerate(self._exec_results) if result is None]
+        results = []
+
+        try:
+            results = self._shell.exec_commands([self._exec_commands[index] for index in pending],
+                                                self._exec_concurrency)
+        except TimeoutError as e:
+            results = e.output or []
+            raise
+        finally:
+            for index, result in zip(pending, results):
+                if result['exit_code'] is None:
+                    # Output of commands which didn't finish is not part of the checkpoint
+                    self._unfinished_outputs[index] = result
+                else:
+                    self._exec_results[index] = result
+
+        return ''.join(result['stdout'] for result in self._exec_results), self._exec_results
+
+    def _get_partial_exec_results(self):
+        return [self._exec_results[index] or self._unfinished_outputs.get(index) or
+                {'cmd': cmd, 'stdout': '', 'stderr': '', 'exit_code': None}
+                for index, cmd in enumerate(self._exec_commands)]
+
+    def _get_groups_output(self, init_plan, plans):
+        """
+        Run every plan on its own interactive channel over the transport of the current session
+        at the same time. The first plan runs on the current session itself. Outputs are merged
+        in the order the plans were declared.
+        """
+        if len(plans) > 1 and not hasattr(self._shell, 'open_channel'):
+            raise ValueError('cmd_groups are not supported by the "%s" handler' % (self._handler))
+
+        outputs = [''] * len(plans)
+        errors = [None] * len(plans)
+
+        threads = []
+        for index, plan in enumerate(plans[1:], 1):
+            thread = threading.Thread(target=self._run_group,
+                                      args=(index, init_plan, plan, outputs, errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            outputs[0] = self._get_shell_output(plans[0], group=0)
+        except Exception as e:
+            errors[0] = e
+
+        for thread in threads:
+            thread.join()
+
+        for error in errors:
+            if error:
+                raise error
+
+        return ''.join(outputs)
+
+    def _compile_plans(self):
+        default_expect = self._config['default_expect']
+
+        if self._cmd_groups is None:
+            return [compile_plan(self._cmds, default_expect)]
+
+        if self._cmds:
+            raise ValueError('cmds and cmd_groups are mutually exclusive')
+
+        if not isinstance(self._cmd_groups, list) or not self._cmd_groups:
+            raise ValueError('cmd_groups must be a non-empty list of command lists')
+
+        return [compile_plan(cmds, default_expect) for cmds in self._cmd_groups]
+
+    def _get_plans_digest(self, init_plan, plans):
+        """
+        Digest identifying the host, the SSH mode, the init_cmds and the commands a checkpoint
+        applies to. None if the plans can't be hashed.
+        """
+        digests = [init_plan.digest] + [plan.digest for plan in plans]
+
+        if None in digests:
+            return None
+
+        return hashlib.sha1(json.dumps([self._host, self._ssh_mode] + digests)
+                            .encode('utf-8')).hexdigest()
+
+    def _load_checkpoint(self, plans):
+        """
+        Set up the per step outputs (per command results in exec mode) to start from: empty
+        ones, or the ones of the resume_from checkpoint of a previous execution which timed out
+        running the same commands.
+        """
+        if self._ssh_mode == 'exec':
+            self._exec_commands = self._get_exec_commands(plans)
+            self._exec_results = [None] * len(self._exec_commands)
+        else:
+            self._step_outputs = [[] for _ in plans]
+
+        if not self._resume_from:
+            return
+
+        if not isinstance(self._resume_from, dict) or \
+                self._resume_from.get('version') != CHECKPOINT_VERSION:
+            raise ValueError('Invalid checkpoint: %s' % (self._resume_from))
+
+        if self._plans_digest is None or self._resume_from.get('digest') != self._plans_digest:
+            raise ValueError('Checkpoint was created for a different host or different commands')
+
+        if self._ssh_mode == 'exec':
+            results = self._resume_from.get('commands')
+
+            if not isinstance(results, list) or len(results) != len(self._exec_commands) or \
+                    any(result is not None and not isinstance(result, dict)
+                        for result in results):
+                raise ValueError('Invalid checkpoint commands: %s' % (results))
+
+            LOG.debug('Resuming from checkpoint, %s commands already finished',
+                      len([result for result in results if result is not None]))
+
+            self._exec_results = list(results)
+            return
+
+        step_outputs = self._resume_from.get('outputs')
+
+        if not isinstance(step_outputs, list) or len(step_outputs) != len(plans) or \
+                any(not isinstance(outputs, list) or len(outputs) > len(plan)
+                    for outputs, plan in zip(step_outputs, plans)):
+            raise ValueError('Invalid checkpoint outputs: %s' % (step_outputs))
+
+        LOG.debug('Resuming from checkpoint, %s steps already finished',
+                  sum(len(outputs) for outputs in step_outputs))
+
+        self._step_outputs = [list(outputs) for outputs in step_outputs]
+
+    def _get_checkpoint(self):
+        """
+        Checkpoint of the steps finished so far which can be passed as resume_from to a later
+        execution. None if the commands can't be resumed.
+        """
+        if self._plans_digest is None:
+            return None
+
+        checkpoint = {
+            'version': CHECKPOINT_VERSION,
+            'digest': self._plans_digest
+        }
+
+        if self._exec_results is not None:
+            checkpoint['commands'] = list(self._exec_results)
+        elif self._step_outputs is not None:
+            checkpoint['outputs'] = [list(outputs) for outputs in self._step_outputs]
+        else:
+            return None
+
+        return checkpoint
+
+    def _store_output(self, data):
+        # NOTE: Imported here since it pulls in the whole st2 database layer
+        from st2common.services.action import store_execution_output_data
+
+        store_execution_output_data(self.execution, self.action, data, output_type='stdout')
+
+    def _get_output_streamer(self):
+        if not self._stream_output:
+            return None
+
+        if not _is_stream_output_enabled():
+            LOG.debug('Output streaming is disabled in the StackStorm config')
+            return None
+
+        return OutputStreamer(self._store_output)
+
+    def _get_handler_options(self):
+        if self._handler == 'broker':
+            return {
+                'socket_path': self._broker_socket,
+                'port': self._port,
+                'transfer_profile': self._transfer_profile,
+                'compress': self._compress
+            }
+        elif self._handler == 'ssh':
+            return {
+                'port': self._port,
+                'transfer_profile': self._transfer_profile,
+                'compress': self._compress,
+                'mode': self._ssh_mode
+            }
+        elif self._handler == 'pty':
+            return {
+                'command': self._pty_command,
+                'port': self._port,
+                'transfer_profile': self._transfer_profile,
+                'prompt': self._config['default_expect']
+            }
+
+        return {}
+
+    def _open_shell(self):
+        self._session_key = None
+
+        if self._handler not in HANDLERS:
+            raise ValueError('Unknown handler "%s". Valid handlers are: %s' %
+                             (self._handler, ', '.join(sorted(HANDLERS.keys()))))
+
+        handler = HANDLERS[self._handler]
+        handler_options = self._get_handler_options()
+
+        if self._persistent_session and handler.poolable:
+            self._session_key = _session_key(self._handler, self._host, self._username,
+                                             self._password, handler_options)
+            shell = _checkout_session(self._session_key)
+
+            if shell:
+                LOG.debug('Reusing pooled shell session')
+                # Pooled sessions keep their host slot, take it over
+                self._admission, shell.admission = shell.admission, None
+                self._admit()
+                return shell
+
+        self._admit()
+
+        return handler(
+            self._host,
+            self._username,
+            self._password,
+            self._timeout,
+            **handler_options
+        )
+
+    def _init_shell(self, init_plan, shell=None):
+        shell = shell or self._shell
+        state = shell.state
+
+        if init_plan.digest is None or state.init_digest != init_plan.digest:
+            state.init_output = self._get_shell_output(init_plan, shell)
+            state.init_digest = init_plan.digest
+        else:
+            LOG.debug('Session already initialized, skipping init_cmds')
+
+        if self._privilege_password and not state.privileged:
+            LOG.debug('Entering privileged mode')
+            privilege_cmd = self._config.get('privilege_cmd', PRIVILEGE_CMD)
+            privilege_expect = self._config.get('privilege_expect', PRIVILEGE_EXPECT)
+
+            output = shell.send(privilege_cmd, privilege_expect)
+            state.init_output += output if output else ''
+            output = shell.send(self._privilege_password, self._config['default_expect'],
+                                secret=True)
+            state.init_output += output if output else ''
+            state.privileged = True
+
+        return state.init_output
+
+    def _get_admission_slots(self, plans):
+        """
+        Number of host slots the execution needs: one per channel it opens at once, since each
+        of them usually takes a VTY line on the device.
+        """
+        if not self._max_sessions_per_host:
+            return 0
+
+        if self._ssh_mode == 'exec':
+            pending = len([result for result in self._exec_results if result is None])
+            return max(min(self._exec_concurrency, self._max_sessions_per_host, pending), 1)
+
+        if len(plans) > self._max_sessions_per_host:
+            raise ValueError('%s cmd_groups need %s sessions to the host at once but '
+                             'max_sessions_per_host is %s' %
+                             (len(plans), len(plans), self._max_sessions_per_host))
+
+        return len(plans)
+
+    def _admit(self):
+        """
+        Wait for free session slots to the host if the number of concurrent sessions is limited.
+        Slots already held (by a pooled session which is reused) count towards the slots
+        needed. Waiting counts against the action timeout.
+        """
+        if not self._max_sessions_per_host:
+            return
+
+        start = time.time()
+        admission = self._admission or HostSemaphore(self._host, self._max_sessions_per_host,
+                                                     lock_dir=self._admission_lock_dir)
+        self._admission = admission
+        count = self._admission_slots - admission.slots
+        admitted = count <= 0 or admission.acquire(0, count)
+
+        if not admitted:
+            # Idle persistent sessions of this process hold slots too, close them before waiting
+            _terminate_sessions(_evict_host_sessions(self._host), 'idle')
+            admitted = admission.acquire(max(_remaining_time(), 0), count)
+
+        self._admission_wait = round(time.time() - start, 3)
+
+        if not admitted:
+            raise TimeoutError('Timed out waiting for a free session to %s' % (self._host))
+
+        LOG.debug('Admitted to %s after %s seconds', self._host, self._admission_wait)
+
+    def _release_admission(self):
+        if self._admission:
+            self._admission.release()
+            self._admission = None
+
+    def _flush_output(self):
+        if self._streamer:
+            self._streamer.flush()
 
     def _close_shell(self):
         LOG.debug('Terminating shell session')
         self._shell.terminate()
 
+    def _release_shell(self):
+        self._shell_released = True
+
+        if self._session_key:
+            LOG.debug('Returning shell session to the pool')
+            # The host slot stays taken as long as the session is open, the slots of the
+            # channels of cmd_groups (which are closed by now) are released
+            if self._admission:
+                self._admission.release(self._admission.slots - 1)
+            self._shell.admission, self._admission = self._admission, None
+            _checkin_session(self._session_key, self._shell, self._session_idle_timeout)
+        else:
+            self._close_shell()
+
+    def _discard_shell(self):
+        # Session is in an unknown state, make sure it's never reused
+        if self._shell and not self._shell_released:
+            LOG.debug('Discarding shell session')
+            try:
+                self._shell.discard()
+            except Exception as e:
+                LOG.debug('Failed to discard session: %s', e)
+
     def pre_run(self):
         super(ExpectRunner, self).pre_run()
 
@@ -138,10 +916,29 @@ class ExpectRunner(ActionRunner):
         self._username = self.runner_parameters.get('username', None)
         self._password = self.runner_parameters.get('password', None)
         self._host = self.runner_parameters.get('host', None)
+        self._port = self.runner_parameters.get('port', None)
         self._cmds = self.runner_parameters.get('cmds', None)
+        self._cmd_groups = self.runner_parameters.get('cmd_groups', None)
         self._entry = self.runner_parameters.get('entry', None)
         self._grammar = self.runner_parameters.get('grammar', None)
         self._timeout = self.runner_parameters.get('timeout', 60)
+        self._privilege_password = self.runner_parameters.get('privilege_password', None)
+        self._persistent_session = self.runner_parameters.get('persistent_session', False)
+        self._session_idle_timeout = self.runner_parameters.get('session_idle_timeout', 300)
+        self._handler = self.runner_parameters.get('handler', None) or HANDLER
+        self._broker_socket = self.runner_parameters.get('broker_socket', None) or BROKER_SOCKET
+        self._stream_output = self.runner_parameters.get('stream_output', False)
+        self._transfer_profile = self.runner_parameters.get('transfer_profile', None) or 'default'
+        self._compress = self.runner_parameters.get('compress', False)
+        self._pty_command = self.runner_parameters.get('pty_command', None)
+        self._ssh_mode = self.runner_parameters.get('ssh_mode', None) or 'shell'
+        self._result_format = self.runner_parameters.get('result_format', None) or 'default'
+        self._intern_strings = self.runner_parameters.get('intern_strings', False)
+        self._exec_concurrency = self.runner_parameters.get('exec_concurrency', None) or \
+            EXEC_CONCURRENCY
+        self._max_sessions_per_host = self.runner_parameters.get('max_sessions_per_host', None)
+        self._admission_lock_dir = self.runner_parameters.get('admission_lock_dir', None)
+        self._resume_from = self.runner_parameters.get('resume_from', None)
 
         global TIMEOUT
         TIMEOUT = self._timeout
@@ -155,24 +952,44 @@ class ExpectRunner(ActionRunner):
         global ENTRY_TIME
         ENTRY_TIME = time.time()
 
-        try:
-            handler = HANDLERS[HANDLER]
-
-            self._shell = handler(
-                self._host,
-                self._username,
-                self._password,
-                self._timeout
-            )
+        self._shell = None
+        self._shell_released = False
+        self._streamer = self._get_output_streamer()
+        self._admission_wait = None
+        self._plans_digest = None
+        self._step_outputs = None
+        self._exec_commands = None
+        self._exec_results = None
+        self._unfinished_outputs = {}
 
-            init_output = self._get_shell_output(
-                self._config['init_cmds'],
-                self._config['default_expect']
-            )
-            LOG.debug("initial shell output: %s", init_output)
-            output = self._get_shell_output(self._cmds, self._config['default_expect'])
+        try:
+            if self._result_format not in RESULT_FORMATS:
+                raise ValueError('Unknown result format "%s". Valid formats are: %s' %
+                                 (self._result_format, ', '.join(RESULT_FORMATS)))
+
+            init_plan = compile_plan(self._config['init_cmds'], self._config['default_expect'])
+            plans = self._compile_plans()
+            self._plans_digest = self._get_plans_digest(init_plan, plans)
+            self._load_checkpoint(plans)
+            self._admission_slots = self._get_admission_slots(plans)
+            if self._ssh_mode == 'exec' and self._admission_slots:
+                self._exec_concurrency = self._admission_slots
+
+            self._shell = self._open_shell()
+            self._shell.output_callback = self._streamer.write if self._streamer else None
+
+            commands = None
+            if self._ssh_mode == 'exec':
+                # Every command gets a fresh non-interactive session, init_cmds don't apply
+                init_output = ''
+                output, commands = self._get_exec_output()
+            else:
+                init_output = self._init_shell(init_plan)
+                LOG.debug("initial shell output: %s", init_output)
+                output = self._get_groups_output(init_plan, plans)
             LOG.debug("shell output: %s", output)
-            self._close_shell()
+            self._flush_output()
+            self._release_shell()
 
             if self._grammar and len(output) > 0:
                 parsed_output = self._parse(output)
@@ -181,6 +998,11 @@ class ExpectRunner(ActionRunner):
                 # serializable
                 parsed_output = json.dumps(parsed_output)
                 parsed_output = json.loads(parsed_output)
+
+                if self._result_format == 'columnar':
+                    parsed_output = to_columnar(parsed_output,
+                                                intern_strings=self._intern_strings)
+
                 result = {
                     'result': parsed_output,
                     'init_output': init_output,
@@ -191,53 +1013,347 @@ class ExpectRunner(ActionRunner):
                     'init_output': init_output,
                 }
 
+            if commands is not None:
+                result['commands'] = commands
+
             result_status = LIVEACTION_STATUS_SUCCEEDED
 
         except (TimeoutError, socket.timeout) as e:
             LOG.debug("Timed out running action: %s", e)
+            self._flush_output()
+            self._discard_shell()
             result_status = LIVEACTION_STATUS_TIMED_OUT
             error_message = dict(
                 result=None,
                 error='Action failed to complete in %s seconds' % TIMEOUT,
                 exit_code=-9
             )
+
+            checkpoint = self._get_checkpoint()
+            if checkpoint and self._exec_results is not None:
+                commands = self._get_partial_exec_results()
+                error_message['partial_output'] = ''.join(result['stdout'] for result in commands)
+                error_message['commands'] = commands
+                error_message['checkpoint'] = checkpoint
+            elif checkpoint:
+                error_message['partial_output'] = ''.join(
+                    ''.join(outputs) + self._unfinished_outputs.get(index, '')
+                    for index, outputs in enumerate(checkpoint['outputs']))
+                error_message['checkpoint'] = checkpoint
+
             result = error_message
 
         except Exception as e:
             LOG.debug("Hit exception running action: %s", e)
+            self._flush_output()
+            self._discard_shell()
             result_status = LIVEACTION_STATUS_FAILED
             error_message = dict(error="%s" % e, result=None)
             result = error_message
 
+        self._release_admission()
+
+        if self._admission_wait is not None:
+            result['admission_wait'] = self._admission_wait
+
         return (result_status, result, None)
 
 
+class CommandStep(object):
+    """
+    A single validated command along with its precompiled expect regex (or None).
+    """
+    __slots__ = ('cmd', 'expect')
+
+    def __init__(self, cmd, expect):
+        object.__setattr__(self, 'cmd', cmd)
+        object.__setattr__(self, 'expect', expect)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % (type(self).__name__))
+
+    def __repr__(self):
+        expect = self.expect.pattern if self.expect is not None else None
+        return '%s(%r, %r)' % (type(self).__name__, self.cmd, expect)
+
+
+class CommandPlan(object):
+    """
+    An immutable, reusable sequence of CommandSteps. ``digest`` identifies the plan content and
+    is None for plans which couldn't be hashed (and thus aren't cached).
+    """
+    __slots__ = ('digest', 'steps')
+
+    def __init__(self, digest, steps):
+        object.__setattr__(self, 'digest', digest)
+        object.__setattr__(self, 'steps', tuple(steps))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % (type(self).__name__))
+
+    def __len__(self):
+        return len(self.steps)
+
+
+class SessionState(object):
+    """
+    Tracks what has already been done on a session so it isn't repeated when the session is
+    reused: digest and output of the init_cmds plan which was run and whether privileged mode
+    was entered.
+    """
+    __slots__ = ('init_digest', 'init_output', 'privileged', 'expires_at')
+
+    def __init__(self):
+        self.init_digest = None
+        self.init_output = ''
+        self.privileged = False
+        self.expires_at = 0
+
+
+class OutputStreamer(object):
+    """
+    Collects output as it is received and passes it on to store_func in batches of (roughly)
+    STREAM_BATCH_SIZE characters or every STREAM_BATCH_INTERVAL seconds, whichever comes first.
+    A timer makes sure buffered output is stored on time even if nothing else is received
+    (e.g. "Erasing flash..." followed by minutes of silence).
+    """
+
+    def __init__(self, store_func, batch_size=None, batch_interval=None):
+        self._store_func = store_func
+        self._batch_size = batch_size or STREAM_BATCH_SIZE
+        self._batch_interval = batch_interval or STREAM_BATCH_INTERVAL
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.time()
+        self._timer = None
+
+    def write(self, data):
+        if not data:
+            return
+
+        with self._lock:
+            self._buffer.append(data)
+            self._buffered += len(data)
+
+            if self._buffered >= self._batch_size or \
+                    time.time() - self._last_flush >= self._batch_interval:
+                self._flush()
+            elif self._timer is None:
+                self._schedule(self._batch_interval - (time.time() - self._last_flush))
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _schedule(self, delay):
+        self._timer = threading.Timer(max(delay, 0), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+
+            if not self._buffer:
+                return
+
+            remaining = self._batch_interval - (time.time() - self._last_flush)
+            if remaining > 0:
+                self._schedule(remaining)
+            else:
+                self._flush()
+
+    def _flush(self):
+        self._last_flush = time.time()
+
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._buffer:
+            return
+
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        try:
+            self._store_func(data)
+        except Exception as e:
+            # Streaming is best effort, it should never fail the action
+            LOG.warning('Failed to store execution output: %s', e)
+
+
 class ConnectionHandler(object):
-    def send(self, command, expect):
+    # Whether sessions of this handler can be kept in the in-process session pool
+    poolable = True
+
+    def __init__(self):
+        self.state = SessionState()
+        # Called with every chunk of output as it is received
+        self.output_callback = None
+        # Host slot (HostSemaphore) held by the session while it's idle in the session pool
+        self.admission = None
+
+    def send(self, command, expect, secret=False):
+        pass
+
+    def terminate(self):
         pass
 
+    def discard(self):
+        """
+        Terminate a session which is in an unknown state (e.g. after an error).
+        """
+        self.terminate()
+
+    def is_alive(self):
+        return True
+
 
 class SSHHandler(ConnectionHandler):
-    def __init__(self, host, username, password, timeout):
+    def __init__(self, host, username, password, timeout, port=None, transfer_profile='default',
+                 compress=False, mode='shell'):
+        super(SSHHandler, self).__init__()
+
+        if mode not in ('shell', 'exec'):
+            raise ValueError('Unknown mode "%s". Valid modes are: exec, shell' % (mode))
+
+        if transfer_profile not in TRANSFER_PROFILES:
+            raise ValueError('Unknown transfer profile "%s". Valid profiles are: %s' %
+                             (transfer_profile, ', '.join(sorted(TRANSFER_PROFILES.keys()))))
+
+        self._profile = TRANSFER_PROFILES[transfer_profile]
+
+        connect_kwargs = {}
+        if port:
+            connect_kwargs['port'] = port
+        if compress:
+            connect_kwargs['compress'] = True
+
+        paramiko = _get_paramiko()
         self._ssh = paramiko.SSHClient()
         self._ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self._ssh.connect(
             host,
             username=username,
             password=password,
-            timeout=timeout
+            timeout=timeout,
+            **connect_kwargs
         )
-        self._shell = self._ssh.invoke_shell(term='vt100', width=200, height=200)
+
+        # Channels opened from now on use these flow control settings
+        transport = self._ssh.get_transport()
+        if self._profile['window_size']:
+            transport.default_window_size = self._profile['window_size']
+        if self._profile['max_packet_size']:
+            transport.default_max_packet_size = self._profile['max_packet_size']
+
+        # In exec mode every command gets its own channel, there's no interactive shell
+        self._shell = None
+        if mode == 'shell':
+            self._open_shell()
+
+    def _open_shell(self):
+        self._shell = self._ssh.invoke_shell(term='vt100', width=self._profile['term_width'],
+                                             height=self._profile['term_height'])
         self._shell.settimeout(_remaining_time())
         self._recv()
 
+    def open_channel(self):
+        """
+        Open another interactive channel over the already authenticated transport.
+        """
+        return SSHChannelHandler(self)
+
     def terminate(self):
-        self._shell.close()
+        if self._shell:
+            self._shell.close()
         self._ssh.close()
 
-    def send(self, command, expect):
+    def is_alive(self):
+        transport = self._ssh.get_transport()
+        return transport is not None and transport.is_active() and \
+            (self._shell is None or not self._shell.closed)
+
+    def exec_commands(self, commands, concurrency=EXEC_CONCURRENCY):
+        """
+        Run every command on its own exec channel over the session transport, up to concurrency
+        commands at once. Completion is detected from the channel EOF and exit status instead of
+        expects. Returns a list with the "cmd", "stdout", "stderr" and "exit_code" of every
+        command in the order the commands were provided.
+        """
+        transport = self._ssh.get_transport()
+        recv_size = self._profile['recv_size']
+        poll_interval = self._profile['poll_interval'] or SLEEP_TIMER
+
+        results = [{'cmd': cmd, 'stdout': '', 'stderr': '', 'exit_code': None}
+                   for cmd in commands]
+        pending = collections.deque(range(len(commands)))
+        running = {}
+
+        try:
+            while pending or running:
+                while pending and len(running) < concurrency:
+                    index = pending.popleft()
+                    LOG.debug('Executing command: %s', commands[index])
+                    channel = transport.open_session()
+                    channel.settimeout(max(_remaining_time(), 0))
+                    channel.exec_command(commands[index])
+                    decoders = [codecs.getincrementaldecoder('utf-8')(errors='ignore')
+                                for _ in range(2)]
+                    running[index] = (channel, decoders)
+
+                received = False
+
+                for index, (channel, decoders) in list(running.items()):
+                    # Check for EOF / close before draining the channel. The transport thread
+                    # buffers all the data before it sets either, so nothing can arrive after
+                    # the drain below once they were seen. Peers may close the channel without
+                    # sending EOF first.
+                    finished = channel.closed or \
+                        (channel.eof_received and channel.exit_status_ready())
+
+                    while channel.recv_ready():
+                        output = decoders[0].decode(channel.recv(recv_size))
+                        if output and self.output_callback:
+                            self.output_callback(output)
+                        results[index]['stdout'] += output
+                        received = True
+
+                    while channel.recv_stderr_ready():
+                        results[index]['stderr'] += decoders[1].decode(
+                            channel.recv_stderr(recv_size))
+                        received = True
+
+                    if finished:
+                        results[index]['exit_code'] = channel.recv_exit_status()
+                        LOG.debug('Command %s exited with %s', commands[index],
+                                  results[index]['exit_code'])
+                        channel.close()
+                        del running[index]
+                        received = True
+
+                if not _check_timer():
+                    raise TimeoutError("Reached timeout (%s seconds). %s of %s commands finished" %
+                                       (_get_timeout(),
+                                        len(commands) - len(pending) - len(running),
+                                        len(commands)),
+                                       output=results)
+
+                if not received:
+                    time.sleep(poll_interval)
+        finally:
+            for channel, _ in running.values():
+                channel.close()
+
+        return results
+
+    def send(self, command, expect, secret=False):
         self._shell.settimeout(_remaining_time())
-        LOG.debug('Entering send: (%s, %s)', command, expect)
+        LOG.debug('Entering send: (%s, %s)', '********' if secret else command, expect)
 
         if not command and not expect:
             raise ValueError("Expect and command cannot both be NoneType.")
@@ -257,9 +1373,18 @@ class SSHHandler(ConnectionHandler):
 
         return output
 
+    def _wait_readable(self, timeout):
+        """
+        Block until the channel has data (or EOF) or timeout seconds have passed.
+        """
+        readable, _, _ = select.select([self._shell], [], [], max(timeout, 0))
+        return bool(readable)
+
     def _recv(self, expect=None, continue_return=False):
         LOG.debug("  receiving (%s, %s)", expect, continue_return)
         return_val = ''
+        recv_size = self._profile['recv_size']
+        poll_interval = self._profile['poll_interval'] or SLEEP_TIMER
 
         while not self._shell.recv_ready() and not self._shell.recv_stderr_ready() and \
                 _check_timer():
@@ -267,8 +1392,9 @@ class SSHHandler(ConnectionHandler):
             if continue_return:
                 LOG.debug("    sending newline")
                 self._shell.send("\n")
-            LOG.debug("    sleeping for %s", SLEEP_TIMER)
-            time.sleep(SLEEP_TIMER)
+                self._wait_readable(min(poll_interval, _remaining_time()))
+            else:
+                self._wait_readable(_remaining_time())
 
         # If we have an error, return it
         # Note that since this is an error, we ignore the timeout timer when
@@ -278,8 +1404,8 @@ class SSHHandler(ConnectionHandler):
             # Note: an excellent place for Python 3.8's "walrus" operator here
             error = 'notblank'
             while error != '':
-                LOG.debug("  receiving 1024 characters from shell")
-                error = self._shell.recv_stderr(1024)
+                LOG.debug("  receiving %s characters from shell", recv_size)
+                error = self._shell.recv_stderr(recv_size)
                 LOG.debug("  received %s bytes", len(error))
                 if isinstance(error, bytes):
                     try:
@@ -287,6 +1413,8 @@ class SSHHandler(ConnectionHandler):
                     except UnicodeDecodeError:
                         error = error.decode("utf-8", errors='ignore')
                 LOG.debug("  error from shell.recv_stderr(): %s", error)
+                if error and self.output_callback:
+                    self.output_callback(error)
                 return_val += error if error else ''
             return return_val
 
@@ -297,11 +1425,16 @@ class SSHHandler(ConnectionHandler):
         while _check_timer():
             # Double check that the command has output available for us
             if not self._shell.recv_ready():
-                LOG.debug("  shell not ready, sleeping %s", SLEEP_TIMER)
-                time.sleep(SLEEP_TIMER)
+                if self._shell.recv_stderr_ready():
+                    # the channel stays readable while stderr is buffered, don't spin on it
+                    LOG.debug("  shell not ready, sleeping %s", poll_interval)
+                    time.sleep(poll_interval)
+                else:
+                    LOG.debug("  shell not ready, waiting for output")
+                    self._wait_readable(_remaining_time())
                 continue
-            LOG.debug("  receiving 1024 characters from shell")
-            output = self._shell.recv(1024)
+            LOG.debug("  receiving %s characters from shell", recv_size)
+            output = self._shell.recv(recv_size)
             LOG.debug("  received %s bytes", len(output))
             if isinstance(output, bytes):
                 try:
@@ -309,11 +1442,14 @@ class SSHHandler(ConnectionHandler):
                 except UnicodeDecodeError:
                     output = output.decode("utf-8", errors='ignore')
             LOG.debug("  output from shell.recv(): %s", output)
+            if output and self.output_callback:
+                self.output_callback(output)
             return_val += output if output else ''
 
             LOG.debug("  expect: %s", expect)
-            LOG.debug("  return val: %s", return_val)
-            if (expect and _expect_return(expect, return_val)) or not expect:
+            if not expect or \
+                    _expect_return(expect, return_val,
+                                   _expect_search_pos(expect, return_val, len(output or ''))):
                 LOG.debug("    expect matched return value")
                 break
 
@@ -322,9 +1458,349 @@ class SSHHandler(ConnectionHandler):
                 self._shell.send("\n")
 
         if not _check_timer():
-            raise TimeoutError("Reached timeout (%s seconds). Recieved: %s" % (TIMEOUT, return_val))
+            raise TimeoutError("Reached timeout (%s seconds). Recieved: %s" % (_get_timeout(),
+                                                                              return_val),
+                               output=return_val)
 
         return return_val
 
 
+class SSHChannelHandler(SSHHandler):
+    """
+    Additional interactive channel sharing the transport (and login) of an SSHHandler. Closing
+    it leaves the transport open.
+    """
+
+    poolable = False
+
+    def __init__(self, parent):
+        ConnectionHandler.__init__(self)
+
+        self._profile = parent._profile
+        self._ssh = parent._ssh
+        self._open_shell()
+
+    def terminate(self):
+        self._shell.close()
+
+
+def _set_controlling_tty():
+    # Make the pseudo terminal the controlling terminal of the spawned command so programs
+    # reading from /dev/tty (e.g. ssh password prompts) work
+    os.setsid()
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+class PTYHandler(ConnectionHandler):
+    """
+    Drives a command spawned locally in a pseudo terminal: OpenSSH (which can reuse
+    ControlMaster connections), jump host wrappers or local CLI tools. Output is read using
+    non-blocking reads driven by select() with the same expect semantics as SSHHandler.
+    """
+
+    def __init__(self, host, username, password, timeout, command=None, port=None,
+                 transfer_profile='default', prompt=None):
+        super(PTYHandler, self).__init__()
+
+        if transfer_profile not in TRANSFER_PROFILES:
+            raise ValueError('Unknown transfer profile "%s". Valid profiles are: %s' %
+                             (transfer_profile, ', '.join(sorted(TRANSFER_PROFILES.keys()))))
+
+        self._profile = TRANSFER_PROFILES[transfer_profile]
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+
+        # Only the documented placeholders are replaced, arguments may contain other braces
+        # (awk programs, JSON, ...)
+        placeholders = {'{host}': host or '', '{port}': str(port or 22),
+                        '{username}': username or ''}
+        args = []
+        for arg in (command or PTY_COMMAND):
+            for placeholder, value in placeholders.items():
+                arg = arg.replace(placeholder, value)
+            args.append(arg)
+        LOG.debug('Spawning %s', args)
+
+        master, slave = pty.openpty()
+        fcntl.ioctl(slave, termios.TIOCSWINSZ,
+                    struct.pack('HHHH', self._profile['term_height'], self._profile['term_width'],
+                                0, 0))
+
+        env = os.environ.copy()
+        env['TERM'] = 'vt100'
+
+        try:
+            self._process = subprocess.Popen(args, stdin=slave, stdout=slave, stderr=slave,
+                                             env=env, close_fds=True,
+                                             preexec_fn=_set_controlling_tty)
+        except Exception:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+
+        self._fd = master
+        fcntl.fcntl(self._fd, fcntl.F_SETFL, fcntl.fcntl(self._fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        if prompt:
+            # ssh may print warnings or a banner before asking for the password, wait until
+            # either the password or the device prompt shows up before deciding
+            output = self._recv('(?:%s)|(?:%s)' % (PTY_PASSWORD_PROMPT,
+                                                   getattr(prompt, 'pattern', prompt)))
+            output += self._read_pending(self._profile['poll_interval'] or SLEEP_TIMER)
+        else:
+            output = self._recv()
+
+        if password and re.search(PTY_PASSWORD_PROMPT, output):
+            LOG.debug('Answering password prompt')
+            self._write(password + '\n')
+            self._recv(prompt)
+
+    def terminate(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+        if self._process.poll() is None:
+            self._process.send_signal(signal.SIGHUP)
+
+            for _ in range(10):
+                if self._process.poll() is not None:
+                    break
+                time.sleep(SLEEP_TIMER)
+            else:
+                self._process.kill()
+                self._process.wait()
+
+    def is_alive(self):
+        return self._fd is not None and self._process.poll() is None
+
+    def send(self, command, expect, secret=False):
+        LOG.debug('Entering send: (%s, %s)', '********' if secret else command, expect)
+
+        if not command and not expect:
+            raise ValueError("Expect and command cannot both be NoneType.")
+
+        if command:
+            self._write(command + "\n")
+        else:
+            return self._recv(expect, True)
+
+        output = None
+
+        if expect:
+            output = self._recv(expect)
+
+            output = output.replace('\\n', '\n').replace('\r', '').replace('\\r', '')
+            LOG.debug('Output: %s', output)
+
+        return output
+
+    def _write(self, data):
+        data = data.encode('utf-8')
+
+        while data:
+            _, writable, _ = select.select([], [self._fd], [], max(_remaining_time(), 0))
+            if not writable:
+                raise TimeoutError("Reached timeout (%s seconds) writing to the terminal" %
+                                   (_get_timeout()))
+            data = data[os.write(self._fd, data):]
+
+    def _read(self):
+        """
+        Read the available output, returns None once the command exited.
+        """
+        try:
+            data = os.read(self._fd, self._profile['recv_size'])
+        except OSError as e:
+            # Linux reports a closed pseudo terminal as EIO
+            if e.errno == errno.EIO:
+                return None
+            if e.errno == errno.EAGAIN:
+                return ''
+            raise
+
+        if not data:
+            return None
+
+        return self._decoder.decode(data)
+
+    def _read_pending(self, settle_time):
+        """
+        Read output until none arrives for settle_time seconds. Without an expect this keeps the
+        rest of e.g. a login banner from being mistaken for the output of the next command.
+        """
+        output = ''
+
+        while _check_timer():
+            readable, _, _ = select.select([self._fd], [], [], settle_time)
+            data = self._read() if readable else None
+            if not data:
+                break
+            if self.output_callback:
+                self.output_callback(data)
+            output += data
+
+        return output
+
+    def _recv(self, expect=None, continue_return=False):
+        LOG.debug("  receiving (%s, %s)", expect, continue_return)
+        return_val = ''
+        poll_interval = self._profile['poll_interval'] or SLEEP_TIMER
+
+        while _check_timer():
+            # Keep sending newlines while waiting if asked to, otherwise wait for output for as
+            # long as the timeout allows
+            wait = min(poll_interval, _remaining_time()) if continue_return else _remaining_time()
+            readable, _, _ = select.select([self._fd], [], [], max(wait, 0))
+
+            if not readable:
+                if continue_return:
+                    LOG.debug("  sending newline")
+                    self._write("\n")
+                continue
+
+            output = self._read()
+
+            if output == '':
+                continue
+
+            if output is None:
+                if not expect:
+                    return return_val
+                raise EOFError("Command exited before expect \"%s\" matched. Received: %s" %
+                               (getattr(expect, 'pattern', expect), return_val))
+
+            LOG.debug("  output from terminal: %s", output)
+            if output and self.output_callback:
+                self.output_callback(output)
+            return_val += output
+
+            if not expect:
+                return return_val + self._read_pending(poll_interval)
+
+            if _expect_return(expect, return_val,
+                              _expect_search_pos(expect, return_val, len(output))):
+                LOG.debug("    expect matched return value")
+                return return_val
+
+            if continue_return:
+                LOG.debug("  sending newline")
+                self._write("\n")
+
+        raise TimeoutError("Reached timeout (%s seconds). Recieved: %s" % (_get_timeout(),
+                                                                          return_val),
+                           output=return_val)
+
+
+class BrokerHandler(ConnectionHandler):
+    """
+    Runs commands on a session leased from the session broker daemon (expect_runner/broker.py)
+    which keeps warm sessions shared by all the actionrunner processes on the node.
+
+    The broker is spoken to over a Unix domain socket using newline delimited JSON messages:
+
+    * {"op": "open", "handler", "host", "username", "password", "options", "timeout"} leases a
+      session opened with the handler "options" (port, transfer_profile, compress), the
+      response contains the session "state".
+    * {"op": "send", "cmd", "expect", "secret", "timeout"} runs a command on the leased session,
+      the response contains the "output".
+    * {"op": "release", "healthy", "state"} returns the session to the broker.
+
+    Every response has a "status" of "ok", "timeout" or "error" (with an "error" message).
+    """
+
+    # Sessions are kept by the broker
+    poolable = False
+
+    def __init__(self, host, username, password, timeout, socket_path=None, port=None,
+                 transfer_profile='default', compress=False):
+        super(BrokerHandler, self).__init__()
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.settimeout(max(_remaining_time(), 0) + BROKER_GRACE_PERIOD)
+        self._socket.connect(socket_path or BROKER_SOCKET)
+        self._file = self._socket.makefile('rb')
+
+        try:
+            response = self._request({
+                'op': 'open',
+                'handler': HANDLER,
+                'host': host,
+                'username': username,
+                'password': password,
+                'options': {
+                    'port': port,
+                    'transfer_profile': transfer_profile,
+                    'compress': compress
+                }
+            })
+        except Exception:
+            self._file.close()
+            self._socket.close()
+            raise
+
+        for name, value in response['state'].items():
+            setattr(self.state, name, value)
+
+    def _request(self, request):
+        request['timeout'] = max(_remaining_time(), 0)
+        self._socket.settimeout(request['timeout'] + BROKER_GRACE_PERIOD)
+        self._socket.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+        response = self._file.readline()
+
+        if not response:
+            raise BrokerError('Session broker closed the connection')
+
+        response = json.loads(response.decode('utf-8'))
+
+        if response['status'] == 'timeout':
+            raise TimeoutError(response['error'], output=response.get('output', ''))
+        elif response['status'] != 'ok':
+            raise BrokerError(response['error'])
+
+        return response
+
+    def _release(self, healthy):
+        try:
+            self._request({
+                'op': 'release',
+                'healthy': healthy,
+                'state': {
+                    'init_digest': self.state.init_digest,
+                    'init_output': self.state.init_output,
+                    'privileged': self.state.privileged
+                }
+            })
+        finally:
+            self._file.close()
+            self._socket.close()
+
+    def terminate(self):
+        self._release(True)
+
+    def discard(self):
+        self._release(False)
+
+    def send(self, command, expect, secret=False):
+        LOG.debug('Entering send: (%s, %s)', '********' if secret else command, expect)
+
+        if not command and not expect:
+            raise ValueError("Expect and command cannot both be NoneType.")
+
+        response = self._request({
+            'op': 'send',
+            'cmd': command,
+            'expect': getattr(expect, 'pattern', expect),
+            'secret': secret
+        })
+
+        if response['output'] and self.output_callback:
+            self.output_callback(response['output'])
+
+        return response['output']
+
+
 HANDLERS['ssh'] = SSHHandler
+HANDLERS['pty'] = PTYHandler
+HANDLERS['broker'] = BrokerHandler
@@ -50,5 +50,8 @@ setup(
         'st2common.runners.runner': [
             'expect = expect_runner.expect_runner',
         ],
+        'console_scripts': [
+            'st2-expect-broker = expect_runner.broker:main',
+        ],
     }
 )
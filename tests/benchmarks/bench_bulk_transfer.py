@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Extreme Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare SSHHandler throughput of the transfer profiles on a large output over a slow link.
+
+Starts a local paramiko SSH server which answers the "dump" command with --size MiB of output
+and a proxy in front of it which delays traffic by --latency milliseconds in each direction.
+Besides the default and bulk profiles it measures the bulk window / packet size and the bulk
+read size on their own to tell their effects apart. Usage:
+
+    python tests/benchmarks/bench_bulk_transfer.py [--size 4] [--latency 50]
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import collections
+
+import paramiko
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from expect_runner import expect_runner
+
+PROMPT = 'bench# '
+
+LINE = ('%-79s\r\n' % ('GigabitEthernet1/0/1 is up, line protocol is up (connected)')).encode()
+
+
+class _Server(paramiko.ServerInterface):
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        return True
+
+
+def _serve_ssh(listener, host_key, size):
+    while True:
+        conn, _ = listener.accept()
+        thread = threading.Thread(target=_serve_ssh_connection, args=(conn, host_key, size))
+        thread.daemon = True
+        thread.start()
+
+
+def _serve_ssh_connection(conn, host_key, size):
+    transport = paramiko.Transport(conn)
+    transport.add_server_key(host_key)
+    transport.use_compression(True)
+    transport.start_server(server=_Server())
+
+    channel = transport.accept(20)
+    channel.sendall(PROMPT)
+    dump = LINE * (size // len(LINE))
+
+    buf = b''
+    while True:
+        data = channel.recv(1024)
+        if not data:
+            break
+        buf += data
+        while b'\n' in buf:
+            command, buf = buf.split(b'\n', 1)
+            if command.strip() == b'dump':
+                channel.sendall(dump)
+            channel.sendall(PROMPT)
+
+    transport.close()
+
+
+def _serve_proxy(listener, target, latency):
+    while True:
+        conn, _ = listener.accept()
+        upstream = socket.create_connection(target)
+        for source, destination in [(conn, upstream), (upstream, conn)]:
+            _start_pipe(source, destination, latency)
+
+
+def _start_pipe(source, destination, latency):
+    queue = collections.deque()
+    ready = threading.Condition()
+
+    def read():
+        while True:
+            try:
+                data = source.recv(65536)
+            except socket.error:
+                data = b''
+            with ready:
+                queue.append((time.time() + latency, data))
+                ready.notify()
+            if not data:
+                break
+
+    def write():
+        while True:
+            with ready:
+                while not queue:
+                    ready.wait()
+                due, data = queue.popleft()
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if not data:
+                    destination.shutdown(socket.SHUT_WR)
+                    break
+                destination.sendall(data)
+            except socket.error:
+                # Other side of the connection is already gone
+                break
+
+    for target in [read, write]:
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+
+def _listen(target, *args):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+
+    thread = threading.Thread(target=target, args=(listener,) + args)
+    thread.daemon = True
+    thread.start()
+
+    return listener.getsockname()
+
+
+# Name, profile settings (on top of the default profile) and whether compression is enabled
+VARIANTS = [
+    ('default', {}, False),
+    ('window', {'window_size': 16 * 1024 * 1024, 'max_packet_size': 128 * 1024}, False),
+    ('reads', {'recv_size': 64 * 1024}, False),
+    ('bulk', expect_runner.TRANSFER_PROFILES['bulk'], False),
+    ('bulk', expect_runner.TRANSFER_PROFILES['bulk'], True)
+]
+
+
+def _measure(port, transfer_profile, compress):
+    expect_runner.ENTRY_TIME = time.time()
+    expect_runner.TIMEOUT = 600
+
+    handler = expect_runner.SSHHandler('127.0.0.1', 'bench', 'bench', 30, port=port,
+                                       transfer_profile=transfer_profile, compress=compress)
+
+    try:
+        start = time.time()
+        output = handler.send('dump', 'bench#')
+        return time.time() - start, len(output)
+    finally:
+        handler.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=4, help='Output size in MiB.')
+    parser.add_argument('--latency', type=int, default=50,
+                        help='Delay added in each direction in milliseconds.')
+    args = parser.parse_args()
+
+    host_key = paramiko.RSAKey.generate(2048)
+    ssh_address = _listen(_serve_ssh, host_key, args.size * 1024 * 1024)
+    _, proxy_port = _listen(_serve_proxy, ssh_address, args.latency / 1000.0)
+
+    print('%s MiB output, %s ms one way latency' % (args.size, args.latency))
+
+    for name, settings, compress in VARIANTS:
+        profile = dict(expect_runner.TRANSFER_PROFILES['default'], **settings)
+        expect_runner.TRANSFER_PROFILES['bench'] = profile
+
+        duration, received = _measure(proxy_port, 'bench', compress)
+        print('%-8s compress=%-5s %8.2f s %10.2f MiB/s' %
+              (name, compress, duration, received / duration / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
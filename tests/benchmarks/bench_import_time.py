@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 Extreme Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measure cold "import expect_runner" and get_metadata() time.
+
+Every sample runs in a fresh interpreter so nothing is cached in sys.modules. Usage:
+
+    python tests/benchmarks/bench_import_time.py [--runs 20]
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+
+SAMPLE_CODE = """
+import sys
+import json
+import time
+
+start = time.time()
+from expect_runner import expect_runner
+imported = time.time()
+expect_runner.get_metadata()
+done = time.time()
+
+print(json.dumps({
+    'import': imported - start,
+    'get_metadata': done - imported,
+    'paramiko_loaded': 'paramiko' in sys.modules,
+    'tatsu_loaded': 'tatsu' in sys.modules,
+}))
+"""
+
+
+def _run_sample():
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [BASE_DIR, env.get('PYTHONPATH')]))
+    output = subprocess.check_output([sys.executable, '-c', SAMPLE_CODE], env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20, help='Number of cold samples.')
+    args = parser.parse_args()
+
+    samples = [_run_sample() for _ in range(args.runs)]
+
+    for key in ['import', 'get_metadata']:
+        values = [sample[key] * 1000 for sample in samples]
+        print('%-13s min %8.2f ms   median %8.2f ms   max %8.2f ms' %
+              (key, min(values), _median(values), max(values)))
+
+    print('paramiko loaded: %s' % (any(sample['paramiko_loaded'] for sample in samples)))
+    print('tatsu loaded:    %s' % (any(sample['tatsu_loaded'] for sample in samples)))
+
+
+if __name__ == '__main__':
+    main()
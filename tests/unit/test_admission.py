@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Extreme Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import fcntl
+import shutil
+import tempfile
+
+import unittest2
+
+from expect_runner.admission import HostSemaphore
+
+
+class HostSemaphoreTestCase(unittest2.TestCase):
+    def setUp(self):
+        super(HostSemaphoreTestCase, self).setUp()
+        self._lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._lock_dir)
+        super(HostSemaphoreTestCase, self).tearDown()
+
+    def _get_semaphore(self, host='10.4.2.1', max_sessions=2):
+        return HostSemaphore(host, max_sessions, lock_dir=self._lock_dir)
+
+    def test_max_sessions(self):
+        first = self._get_semaphore()
+        second = self._get_semaphore()
+        third = self._get_semaphore()
+
+        self.assertTrue(first.acquire(0))
+        self.assertTrue(second.acquire(0))
+        self.assertFalse(third.acquire(0.2))
+
+        # Other hosts are not affected
+        self.assertTrue(self._get_semaphore(host='10.4.2.2').acquire(0))
+
+        first.release()
+        self.assertTrue(third.acquire(0))
+
+        second.release()
+        third.release()
+
+    def test_multiple_slots(self):
+        first = self._get_semaphore(max_sessions=3)
+        second = self._get_semaphore(max_sessions=3)
+
+        self.assertTrue(first.acquire(0))
+        self.assertTrue(first.acquire(0, count=1))
+        self.assertEqual(first.slots, 2)
+
+        # Slots are only taken when all of them are free
+        self.assertFalse(second.acquire(0.2, count=2))
+        self.assertEqual(second.slots, 0)
+
+        first.release(1)
+        self.assertEqual(first.slots, 1)
+        self.assertTrue(second.acquire(0, count=2))
+        self.assertFalse(first.acquire(0))
+
+        second.release()
+        first.release()
+        self.assertEqual(second.slots, 0)
+
+    def _add_ticket(self, semaphore, name, locked):
+        semaphore.acquire(0)
+        semaphore.release()
+
+        queue_dir = semaphore._queue_dir
+        fd = os.open(os.path.join(queue_dir, name), os.O_CREAT | os.O_RDWR, 0o600)
+        if locked:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            os.close(fd)
+        return fd
+
+    def test_waiters_are_served_in_order(self):
+        semaphore = self._get_semaphore()
+
+        # Waiter which arrived earlier is still waiting, a free slot is left for it
+        fd = self._add_ticket(semaphore, '0' * 20 + '-1-waiting', locked=True)
+        self.assertFalse(semaphore.acquire(0.2))
+
+        os.close(fd)
+        self.assertTrue(semaphore.acquire(0))
+        semaphore.release()
+
+    def test_abandoned_tickets_are_removed(self):
+        semaphore = self._get_semaphore()
+
+        self._add_ticket(semaphore, '0' * 20 + '-1-abandoned', locked=False)
+        self.assertTrue(semaphore.acquire(0))
+        self.assertEqual(os.listdir(semaphore._queue_dir), [])
+        semaphore.release()
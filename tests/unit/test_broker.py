@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Extreme Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import copy
+import time
+import shutil
+import tempfile
+import threading
+
+import mock
+
+from st2common.constants.action import LIVEACTION_STATUS_SUCCEEDED, LIVEACTION_STATUS_FAILED
+from st2common.constants.action import LIVEACTION_STATUS_TIMED_OUT
+from st2tests.base import RunnerTestCase
+
+from expect_runner import expect_runner
+from expect_runner import broker
+
+
+RUNNER_PARAMETERS = dict(
+    cmds=[
+        'show version',
+        'show interfaces'
+    ],
+    handler='broker',
+    host='10.4.2.1',
+    username='emma',
+    password='stone',
+    timeout=5
+)
+
+MOCK_CONFIG = {
+    'init_cmds': ['terminal length 0'],
+    'default_expect': '#'
+}
+
+
+class FakeHandler(expect_runner.ConnectionHandler):
+    instances = []
+
+    def __init__(self, host, username, password, timeout, **options):
+        super(FakeHandler, self).__init__()
+        self.options = options
+        self.sent = []
+        self.terminated = False
+        FakeHandler.instances.append(self)
+
+    def send(self, command, expect, secret=False):
+        if command == 'reload':
+            raise ValueError('Connection reset by peer')
+        self.sent.append(command)
+        return '%s output\n' % (command)
+
+    def terminate(self):
+        self.terminated = True
+
+
+@mock.patch('expect_runner.expect_runner.HANDLER', 'fake')
+@mock.patch.dict(expect_runner.HANDLERS, {'fake': FakeHandler})
+class SessionBrokerTestCase(RunnerTestCase):
+    def setUp(self):
+        super(SessionBrokerTestCase, self).setUp()
+
+        FakeHandler.instances = []
+
+        self._temp_dir = tempfile.mkdtemp()
+        self._socket_path = os.path.join(self._temp_dir, 'broker.sock')
+        self._broker = broker.SessionBroker(socket_path=self._socket_path,
+                                            max_sessions_per_host=1)
+
+        thread = threading.Thread(target=self._broker.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        while not os.path.exists(self._socket_path):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self._broker.shutdown()
+        shutil.rmtree(self._temp_dir)
+
+        super(SessionBrokerTestCase, self).tearDown()
+
+    def _run(self, **parameters):
+        runner = expect_runner.get_runner(config=MOCK_CONFIG)
+        runner.action = mock.Mock()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['broker_socket'] = self._socket_path
+        runner.runner_parameters.update(parameters)
+        runner.pre_run()
+        return runner.run(None)
+
+    def test_warm_session_is_reused(self):
+        for _ in range(3):
+            (status, output, _) = self._run()
+            self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+            self.assertEqual(output['result'], 'show version output\nshow interfaces output\n')
+            self.assertEqual(output['init_output'], 'terminal length 0 output\n')
+
+        self.assertEqual(len(FakeHandler.instances), 1)
+        session = FakeHandler.instances[0]
+        self.assertEqual(session.sent.count('terminal length 0'), 1)
+        self.assertEqual(session.sent.count('show version'), 3)
+        self.assertFalse(session.terminated)
+
+    def test_failed_session_is_discarded(self):
+        (status, output, _) = self._run(cmds=['reload'])
+        self.assertEqual(status, LIVEACTION_STATUS_FAILED)
+        self.assertEqual(output['error'], 'Connection reset by peer')
+        self.assertTrue(FakeHandler.instances[0].terminated)
+
+        (status, _, _) = self._run()
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(len(FakeHandler.instances), 2)
+
+    def test_handler_options(self):
+        for parameters in [{}, {}, {'port': 2222}, {'transfer_profile': 'bulk', 'compress': True}]:
+            (status, _, _) = self._run(**parameters)
+            self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+
+        # Options are passed on to the handler and sessions are only reused with the same ones
+        self.assertEqual([session.options for session in FakeHandler.instances], [
+            {'transfer_profile': 'default', 'compress': False},
+            {'port': 2222, 'transfer_profile': 'default', 'compress': False},
+            {'transfer_profile': 'bulk', 'compress': True}
+        ])
+
+        with self.assertRaises(expect_runner.BrokerError) as cm:
+            self._broker.acquire({'host': '10.4.2.1', 'options': {'mode': 'exec'}})
+        self.assertEqual(str(cm.exception), 'Unsupported handler options: mode')
+
+    def test_max_sessions_per_host(self):
+        lease = self._broker.acquire({'host': '10.4.2.1', 'username': 'emma', 'password': 'stone',
+                                      'options': {'transfer_profile': 'default',
+                                                  'compress': False},
+                                      'timeout': 1})
+
+        (status, output, _) = self._run(timeout=0.2)
+        self.assertEqual(status, LIVEACTION_STATUS_TIMED_OUT)
+
+        self._broker.release(lease, True)
+
+        (status, output, _) = self._run()
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(len(FakeHandler.instances), 1)
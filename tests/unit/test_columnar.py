@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Extreme Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+
+import unittest2
+
+from expect_runner.columnar import to_columnar
+from expect_runner.columnar import from_columnar
+
+
+INTERFACES = [
+    {'name': 'Gi1/0/1', 'status': 'up',
+     'vlans': [{'id': 1, 'mode': 'access'}, {'id': 10, 'mode': 'trunk'}]},
+    {'name': 'Gi1/0/2', 'status': 'down', 'vlans': []},
+    {'name': 'Gi1/0/3', 'status': 'up', 'vlans': [{'id': 1, 'mode': 'access'}]},
+]
+
+PARSED_OUTPUT = {
+    'interfaces': INTERFACES,
+    'mixed': [{'a': 1}, {'b': 2}],
+    'single': [{'a': 1}],
+    'hostname': 'switch01'
+}
+
+
+class ColumnarTestCase(unittest2.TestCase):
+    def test_to_columnar(self):
+        encoded = to_columnar(copy.deepcopy(PARSED_OUTPUT))
+
+        self.assertEqual(encoded['hostname'], 'switch01')
+        # Lists of records with different keys and single records are left alone
+        self.assertEqual(encoded['mixed'], PARSED_OUTPUT['mixed'])
+        self.assertEqual(encoded['single'], PARSED_OUTPUT['single'])
+
+        interfaces = encoded['interfaces']
+        self.assertEqual(interfaces['__columnar__'], 1)
+        self.assertEqual(interfaces['columns'], ['name', 'status', 'vlans'])
+        self.assertEqual(interfaces['rows'][1], ['Gi1/0/2', 'down', []])
+        self.assertEqual(interfaces['rows'][0][2], {
+            '__columnar__': 1,
+            'columns': ['id', 'mode'],
+            'rows': [[1, 'access'], [10, 'trunk']]
+        })
+        self.assertNotIn('strings', interfaces)
+
+    def test_intern_strings(self):
+        interfaces = to_columnar(INTERFACES, intern_strings=True)
+
+        # Only string columns with repeated values are interned
+        self.assertEqual(interfaces['interned'], ['status'])
+        self.assertEqual(interfaces['strings'], ['up', 'down'])
+        self.assertEqual([row[:2] for row in interfaces['rows']],
+                         [['Gi1/0/1', 0], ['Gi1/0/2', 1], ['Gi1/0/3', 0]])
+
+    def test_round_trip(self):
+        for intern_strings in [False, True]:
+            encoded = to_columnar(copy.deepcopy(PARSED_OUTPUT), intern_strings=intern_strings)
+            self.assertEqual(from_columnar(encoded), PARSED_OUTPUT)
+
+    def test_unsupported_version(self):
+        encoded = to_columnar(INTERFACES)
+        encoded['__columnar__'] = 2
+        self.assertRaises(ValueError, from_columnar, encoded)
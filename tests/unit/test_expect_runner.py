@@ -13,8 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import sys
 import json
+import time
 import copy
+import shutil
+import select
+import tempfile
+import subprocess
+import threading
 
 import six
 import mock
@@ -24,6 +32,8 @@ from st2common.constants.action import LIVEACTION_STATUS_TIMED_OUT
 from st2tests.base import RunnerTestCase
 
 from expect_runner import expect_runner
+from expect_runner.admission import HostSemaphore
+from expect_runner.columnar import from_columnar
 
 
 RUNNER_PARAMETERS = dict(
@@ -49,6 +59,12 @@ MULTIPLE_COMMANDS_DICT_ITEMS = [
     {'cmd': 'one happy command'},
     {'cmd': 'two happy command', 'expect': '#'},
 ]
+COMMAND_GROUPS = [
+    ['one happy command', 'two happy commands'],
+    [{'cmd': 'three happy commands', 'expect': '#'}],
+    ['four happy commands']
+]
+
 NONE_EXPECT = [
     ['one happy command', None]
 ]
@@ -123,7 +139,21 @@ MOCK_JSON_ENTRIES = """{"entries": [{"name": ["George", "Clooney"],
 
 MOCK_BROKEN_GRAMMAR = "entry = {/.*/}"
 
+
+def _get_channel_fd(readable):
+    # stands in for the channel's file descriptor, select() either always or never reports it
+    # as readable
+    read_fd, write_fd = os.pipe()
+    if readable:
+        os.write(write_fd, b'x')
+    return read_fd
+
+
+READABLE_FD = _get_channel_fd(readable=True)
+IDLE_FD = _get_channel_fd(readable=False)
+
 MockParamiko = mock.MagicMock()
+MockParamiko.SSHClient().invoke_shell().fileno.return_value = READABLE_FD
 MockParamiko.SSHClient().invoke_shell().recv_ready.side_effect = \
     lambda: (MockParamiko.SSHClient().invoke_shell().recv_ready.call_count % 2) == 0
 MockParamiko.SSHClient().invoke_shell().recv_stderr_ready.side_effect = \
@@ -131,6 +161,154 @@ MockParamiko.SSHClient().invoke_shell().recv_stderr_ready.side_effect = \
 MockParamiko.SSHClient().invoke_shell().recv.return_value = MOCK_OUTPUT
 
 
+# Fake CLI driven by the "pty" handler
+MOCK_CLI = r'''
+import sys
+import getpass
+
+if getpass.getpass('Password: ') != 'stone':
+    sys.exit(1)
+
+sys.stdout.write('Welcome\nSSH@MyHappyShell#')
+sys.stdout.flush()
+
+for line in iter(sys.stdin.readline, ''):
+    sys.stdout.write('%s: done\nSSH@MyHappyShell#' % (line.strip()))
+    sys.stdout.flush()
+'''
+
+
+# Fake CLI printing a warning a while before it asks for the password, like ssh does for new
+# hosts
+MOCK_CLI_WITH_WARNING = r'''
+import sys
+import time
+
+sys.stdout.write("Warning: Permanently added '10.4.2.1' (RSA) to the list of known hosts.\n")
+sys.stdout.flush()
+time.sleep(0.5)
+''' + MOCK_CLI
+
+
+class MockExecChannel(object):
+    """
+    Exec channel which finishes right away, commands containing "missing" fail.
+    """
+
+    def __init__(self):
+        self.cmd = None
+        self.closed = False
+        self.eof_received = False
+        self._stdout = []
+        self._stderr = []
+
+    def settimeout(self, timeout):
+        pass
+
+    def exec_command(self, cmd):
+        self.cmd = cmd
+        self.eof_received = True
+        if 'missing' in cmd:
+            self._stderr = [b'command not found\n']
+        else:
+            self._stdout = [('%s: done\n' % (cmd)).encode('utf-8'), b'\xc5\x93\n']
+
+    def recv_ready(self):
+        return bool(self._stdout)
+
+    def recv(self, size):
+        return self._stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return bool(self._stderr)
+
+    def recv_stderr(self, size):
+        return self._stderr.pop(0)
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return 127 if 'missing' in self.cmd else 0
+
+    def close(self):
+        self.closed = True
+
+
+class SlowHandler(expect_runner.ConnectionHandler):
+    """
+    Handler which times out waiting for the output of the commands in slow_commands.
+    """
+    instances = []
+    slow_commands = []
+
+    def __init__(self, host, username, password, timeout):
+        super(SlowHandler, self).__init__()
+        self.sent = []
+        SlowHandler.instances.append(self)
+
+    def send(self, command, expect, secret=False):
+        if command in self.slow_commands:
+            raise expect_runner.TimeoutError('Reached timeout waiting for %s' % (command),
+                                             output='%s partial output' % (command))
+        self.sent.append(command)
+        return '%s output\n' % (command)
+
+
+class RacyExecChannel(MockExecChannel):
+    """
+    Exec channel which receives its last chunk of output together with EOF, right after the
+    first chunk was read.
+    """
+
+    @property
+    def eof_received(self):
+        if self.cmd and not self._stdout and not self._eof:
+            self._stdout.append(b'LAST-CHUNK\n')
+            self._eof = True
+        return self._eof
+
+    @eof_received.setter
+    def eof_received(self, value):
+        self._eof = value
+
+    def exec_command(self, cmd):
+        self.cmd = cmd
+        self._stdout = [b'part1 ']
+
+
+class HangingExecChannel(MockExecChannel):
+    """
+    Exec channel on which commands in hanging_commands print something and never finish.
+    """
+    hanging_commands = []
+    commands = []
+
+    def exec_command(self, cmd):
+        HangingExecChannel.commands.append(cmd)
+        if cmd not in self.hanging_commands:
+            return super(HangingExecChannel, self).exec_command(cmd)
+        self.cmd = cmd
+        self._stdout = [b'still running\n']
+
+
+class ClosingExecChannel(MockExecChannel):
+    """
+    Exec channel which is closed by the peer without EOF or an exit status.
+    """
+
+    def exec_command(self, cmd):
+        self.cmd = cmd
+        self.closed = True
+        self._stdout = [b'file1\n', b'file2\n']
+
+    def exit_status_ready(self):
+        return False
+
+    def recv_exit_status(self):
+        return -1
+
+
 MOCK_CONFIG = {
     'init_cmds': ['enable'],
     'default_expect': '#'
@@ -148,6 +326,13 @@ def get_runner(config=None):
 class ExpectRunnerTestCase(RunnerTestCase):
     maxDiff = None
 
+    def test_heavy_dependencies_are_imported_lazily(self):
+        code = ('import sys; from expect_runner import expect_runner; '
+                'expect_runner.get_metadata(); '
+                'print(expect_runner.tatsu is None and expect_runner.paramiko is None)')
+        output = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(output.decode('utf-8').strip(), 'True')
+
     def test_runner_creation(self):
         runner = get_runner()
         self.assertTrue(runner is not None, 'Creation failed. No instance.')
@@ -167,6 +352,33 @@ class ExpectRunnerTestCase(RunnerTestCase):
         self.assertTrue(output is not None)
         self.assertEqual(output['result'], mock_json_entries)
 
+    def test_columnar_result_format(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = MOCK_COMPLEX_GRAMMAR
+        runner.runner_parameters['result_format'] = 'columnar'
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        entries = output['result']['entries']
+        self.assertEqual(entries['columns'], ['name', 'birthday_month', 'age'])
+        self.assertEqual(entries['rows'][1], [['Emma', 'Stone'], 'December', '22'])
+        self.assertEqual(from_columnar(output['result']), json.loads(MOCK_JSON_ENTRIES))
+
+    def test_unknown_result_format(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['result_format'] = 'xml'
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_FAILED)
+        self.assertEqual(output['error'],
+                         'Unknown result format "xml". Valid formats are: default, columnar')
+
     @mock.patch('expect_runner.expect_runner.SLEEP_TIMER', 1)
     def test_expect_timeout(self, *args):
         timeout = 0
@@ -182,7 +394,6 @@ class ExpectRunnerTestCase(RunnerTestCase):
         self.assertEqual(output['error'], 'Action failed to complete in 0 seconds')
         self.assertEqual(output['exit_code'], -9)
 
-    @mock.patch('expect_runner.expect_runner.SLEEP_TIMER', 1)
     def test_expect_timeout_on_expect_fail(self, *args):
         timeout = 0.01
         runner = get_runner()
@@ -191,13 +402,77 @@ class ExpectRunnerTestCase(RunnerTestCase):
         runner.runner_parameters['expects'] = EXPECT_NOT_IN_OUTPUT
         runner.runner_parameters['timeout'] = timeout
         runner.pre_run()
-        (status, output, _) = runner.run(runner.action)
+        # the shell stays silent, the runner has to give up waiting on it
+        shell = MockParamiko.SSHClient().invoke_shell()
+        shell.fileno.return_value = IDLE_FD
+        try:
+            (status, output, _) = runner.run(runner.action)
+        finally:
+            shell.fileno.return_value = READABLE_FD
         self.assertEqual(status, LIVEACTION_STATUS_TIMED_OUT)
         self.assertTrue(output is not None)
         self.assertEqual(output['result'], None)
         self.assertEqual(output['error'], 'Action failed to complete in 0.01 seconds')
         self.assertEqual(output['exit_code'], -9)
 
+    @mock.patch.dict(expect_runner.HANDLERS, {'slow': SlowHandler})
+    def test_resume_from_checkpoint(self):
+        SlowHandler.instances = []
+        SlowHandler.slow_commands = ['two happy commands']
+
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['cmds'] = MULTIPLE_COMMANDS + ['three happy commands']
+        runner.runner_parameters['handler'] = 'slow'
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_TIMED_OUT)
+        self.assertEqual(output['result'], None)
+        self.assertEqual(output['exit_code'], -9)
+        # Output received for the step which timed out is only part of the partial output
+        self.assertEqual(output['partial_output'],
+                         'one happy command output\ntwo happy commands partial output')
+        checkpoint = output['checkpoint']
+        self.assertEqual(checkpoint['outputs'], [['one happy command output\n']])
+
+        # Checkpoint survives the round trip through the database
+        SlowHandler.slow_commands = []
+        runner.runner_parameters['resume_from'] = json.loads(json.dumps(checkpoint))
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(output['result'], 'one happy command output\n'
+                                           'two happy commands output\n'
+                                           'three happy commands output\n')
+        self.assertEqual(SlowHandler.instances[1].sent,
+                         ['enable', 'two happy commands', 'three happy commands'])
+
+        # Checkpoints only apply to the host, init_cmds and commands they were created for
+        for parameters, config in [({'cmds': MULTIPLE_COMMANDS}, None),
+                                   ({'host': '10.4.2.2'}, None),
+                                   ({}, {'init_cmds': ['terminal length 0'],
+                                         'default_expect': '#'})]:
+            runner = get_runner(config=config)
+            runner.action = self._get_mock_action_obj()
+            runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+            runner.runner_parameters['grammar'] = None
+            runner.runner_parameters['cmds'] = MULTIPLE_COMMANDS + ['three happy commands']
+            runner.runner_parameters['handler'] = 'slow'
+            runner.runner_parameters['resume_from'] = checkpoint
+            runner.runner_parameters.update(parameters)
+            runner.pre_run()
+            (status, output, _) = runner.run(None)
+
+            self.assertEqual(status, LIVEACTION_STATUS_FAILED)
+            self.assertEqual(output['error'],
+                             'Checkpoint was created for a different host or different commands')
+
+        self.assertEqual(len(SlowHandler.instances), 2)
+
     def test_expect_succeeded(self):
         runner = get_runner()
         runner.action = self._get_mock_action_obj()
@@ -241,6 +516,218 @@ class ExpectRunnerTestCase(RunnerTestCase):
         self.assertTrue(output is not None)
         self.assertEqual(output['result'], MOCK_OUTPUT * 2)
 
+    def test_cmd_groups(self):
+        ssh_client = MockParamiko.SSHClient()
+        shell = ssh_client.invoke_shell()
+        MockParamiko.reset_mock()
+
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['cmds'] = None
+        runner.runner_parameters['cmd_groups'] = COMMAND_GROUPS
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(output['result'], MOCK_OUTPUT * 4)
+
+        # One login, one channel per group, init_cmds run on every channel
+        self.assertEqual(ssh_client.connect.call_count, 1)
+        self.assertEqual(shell.send.call_args_list.count(mock.call('enable\n')), 3)
+        for cmd in ['one happy command', 'three happy commands', 'four happy commands']:
+            shell.send.assert_any_call(cmd + '\n')
+        self.assertEqual(shell.close.call_count, 3)
+        self.assertEqual(ssh_client.close.call_count, 1)
+
+    def test_cmd_groups_and_cmds_are_exclusive(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['cmd_groups'] = COMMAND_GROUPS
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_FAILED)
+        self.assertEqual(output['error'], 'cmds and cmd_groups are mutually exclusive')
+
+    @mock.patch('expect_runner.expect_runner._is_stream_output_enabled',
+                mock.Mock(return_value=True))
+    def test_stream_output(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['cmds'] = MULTIPLE_COMMANDS
+        runner.runner_parameters['stream_output'] = True
+        runner.pre_run()
+
+        with mock.patch.object(runner, '_store_output') as store_output:
+            (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        # Init output, output of both the commands
+        streamed = ''.join(call[0][0] for call in store_output.call_args_list)
+        self.assertEqual(streamed, MOCK_OUTPUT * 3)
+
+    def test_output_streamer_batches(self):
+        store_func = mock.Mock()
+        streamer = expect_runner.OutputStreamer(store_func, batch_size=10, batch_interval=60)
+
+        streamer.write('12345')
+        streamer.write('')
+        self.assertEqual(store_func.call_count, 0)
+        streamer.write('67890abc')
+        store_func.assert_called_once_with('1234567890abc')
+
+        streamer.write('def')
+        with mock.patch('expect_runner.expect_runner.time.time', return_value=time.time() + 61):
+            streamer.write('g')
+        store_func.assert_called_with('defg')
+
+        streamer.write('h')
+        streamer.flush()
+        store_func.assert_called_with('h')
+        streamer.flush()
+        self.assertEqual(store_func.call_count, 3)
+
+    @mock.patch('expect_runner.expect_runner.threading.Timer')
+    def test_output_streamer_flushes_on_silence(self, timer_cls):
+        store_func = mock.Mock()
+        now = time.time()
+
+        with mock.patch('expect_runner.expect_runner.time.time', return_value=now):
+            streamer = expect_runner.OutputStreamer(store_func, batch_size=4096,
+                                                    batch_interval=60)
+            streamer.write('Erasing flash...')
+
+        # Nothing else is written, the timer stores the output once the interval passed
+        self.assertEqual(timer_cls.call_args[0][0], 60)
+        on_timer = timer_cls.call_args[0][1]
+
+        with mock.patch('expect_runner.expect_runner.time.time', return_value=now + 30):
+            on_timer()
+        self.assertEqual(store_func.call_count, 0)
+        self.assertEqual(timer_cls.call_args[0][0], 30)
+
+        with mock.patch('expect_runner.expect_runner.time.time', return_value=now + 60):
+            timer_cls.call_args[0][1]()
+        store_func.assert_called_once_with('Erasing flash...')
+
+        # Flushing cancels the pending timer
+        streamer.write('done')
+        streamer.flush()
+        timer_cls.return_value.cancel.assert_called_with()
+
+    def test_max_sessions_per_host(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['max_sessions_per_host'] = 1
+        runner.runner_parameters['admission_lock_dir'] = lock_dir
+        runner.runner_parameters['timeout'] = 0.3
+        runner.pre_run()
+
+        # Another execution holds the only slot
+        semaphore = HostSemaphore(RUNNER_PARAMETERS['host'], 1, lock_dir=lock_dir)
+        self.assertTrue(semaphore.acquire(0))
+
+        (status, output, _) = runner.run(None)
+        self.assertEqual(status, LIVEACTION_STATUS_TIMED_OUT)
+        self.assertEqual(output['result'], None)
+        self.assertGreater(output['admission_wait'], 0.2)
+
+        semaphore.release()
+
+        runner.runner_parameters['timeout'] = 60
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertLess(output['admission_wait'], 1)
+
+        # Slot is released once the action is done
+        self.assertTrue(semaphore.acquire(0))
+        semaphore.release()
+
+    def test_max_sessions_per_host_cmd_groups(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+
+        semaphore = HostSemaphore(RUNNER_PARAMETERS['host'], 3, lock_dir=lock_dir)
+        self.assertTrue(semaphore.acquire(0))
+
+        def run(max_sessions_per_host, timeout=0.3):
+            runner = get_runner()
+            runner.action = self._get_mock_action_obj()
+            runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+            runner.runner_parameters['grammar'] = None
+            runner.runner_parameters['cmds'] = None
+            runner.runner_parameters['cmd_groups'] = COMMAND_GROUPS
+            runner.runner_parameters['max_sessions_per_host'] = max_sessions_per_host
+            runner.runner_parameters['admission_lock_dir'] = lock_dir
+            runner.runner_parameters['timeout'] = timeout
+            runner.pre_run()
+            return runner.run(None)
+
+        (status, output, _) = run(2)
+        self.assertEqual(status, LIVEACTION_STATUS_FAILED)
+        self.assertEqual(output['error'], '3 cmd_groups need 3 sessions to the host at once but '
+                                          'max_sessions_per_host is 2')
+
+        # Every group channel takes a slot, 2 of 3 are free
+        (status, output, _) = run(3)
+        self.assertEqual(status, LIVEACTION_STATUS_TIMED_OUT)
+
+        semaphore.release()
+        (status, output, _) = run(3, timeout=60)
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+
+        # All the slots are released once the action is done
+        self.assertTrue(semaphore.acquire(0, count=3))
+        semaphore.release()
+
+    def test_max_sessions_per_host_persistent_session(self):
+        expect_runner._SESSION_POOL.clear()
+        self.addCleanup(expect_runner._SESSION_POOL.clear)
+
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+
+        ssh_client = MockParamiko.SSHClient()
+        shell = ssh_client.invoke_shell()
+        MockParamiko.reset_mock()
+        semaphore = HostSemaphore(RUNNER_PARAMETERS['host'], 1, lock_dir=lock_dir)
+
+        with mock.patch.object(shell, 'closed', False):
+            for username in ['emma', 'emma', 'kevin']:
+                runner = get_runner()
+                runner.action = self._get_mock_action_obj()
+                runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+                runner.runner_parameters['username'] = username
+                runner.runner_parameters['persistent_session'] = True
+                runner.runner_parameters['max_sessions_per_host'] = 1
+                runner.runner_parameters['admission_lock_dir'] = lock_dir
+                runner.pre_run()
+                (status, output, _) = runner.run(None)
+                self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+                self.assertLess(output['admission_wait'], 1)
+
+                # Pooled session keeps holding the slot
+                self.assertFalse(semaphore.acquire(0))
+
+        # Session was reused once, the idle one was closed to make room for other credentials
+        self.assertEqual(ssh_client.connect.call_count, 2)
+        self.assertEqual(ssh_client.close.call_count, 1)
+
+        (session,) = expect_runner._SESSION_POOL.popitem()[1]
+        expect_runner._terminate_session(session)
+
+        self.assertTrue(semaphore.acquire(0))
+        semaphore.release()
+
     def test_paramiko_interface(self):
         runner = get_runner()
         runner.action = self._get_mock_action_obj()
@@ -267,6 +754,334 @@ class ExpectRunnerTestCase(RunnerTestCase):
         shell.settimeout.assert_called()
         shell.recv.assert_called_with(1024)
 
+    def test_bulk_transfer_profile(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['port'] = 2222
+        runner.runner_parameters['transfer_profile'] = 'bulk'
+        runner.runner_parameters['compress'] = True
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+
+        ssh_client = MockParamiko.SSHClient()
+        shell = ssh_client.invoke_shell()
+        transport = ssh_client.get_transport()
+
+        ssh_client.connect.assert_called_with(
+            RUNNER_PARAMETERS['host'],
+            username=RUNNER_PARAMETERS['username'],
+            password=RUNNER_PARAMETERS['password'],
+            timeout=RUNNER_PARAMETERS['timeout'],
+            port=2222,
+            compress=True
+        )
+        self.assertEqual(transport.default_window_size, 16 * 1024 * 1024)
+        self.assertEqual(transport.default_max_packet_size, 128 * 1024)
+        ssh_client.invoke_shell.assert_any_call(term='vt100', width=1024, height=200)
+        shell.recv.assert_called_with(64 * 1024)
+
+    def test_expect_split_across_reads(self):
+        handler = expect_runner.SSHHandler.__new__(expect_runner.SSHHandler)
+        expect_runner.ConnectionHandler.__init__(handler)
+        handler._profile = expect_runner.TRANSFER_PROFILES['default']
+        handler._shell = mock.Mock()
+        handler._shell.recv_ready.return_value = True
+        handler._shell.recv_stderr_ready.return_value = False
+        handler._shell.recv.side_effect = [b'x' * 10000, b'SSH@My', b'HappyShell#', b'extra']
+
+        expect_runner.ENTRY_TIME = time.time()
+        expect_runner.TIMEOUT = 60
+
+        self.assertEqual(handler._recv(r'(?<=x)SSH@MyHappyShell#$'),
+                         'x' * 10000 + 'SSH@MyHappyShell#')
+        self.assertEqual(handler._shell.recv.call_count, 3)
+
+    def test_recv_waits_on_channel(self):
+        handler = expect_runner.SSHHandler.__new__(expect_runner.SSHHandler)
+        expect_runner.ConnectionHandler.__init__(handler)
+        handler._profile = expect_runner.TRANSFER_PROFILES['bulk']
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        handler._shell = mock.Mock()
+        handler._shell.fileno.return_value = read_fd
+        handler._shell.recv_ready.side_effect = \
+            lambda: bool(select.select([read_fd], [], [], 0)[0])
+        handler._shell.recv_stderr_ready.return_value = False
+        handler._shell.recv.side_effect = lambda size: os.read(read_fd, size)
+
+        expect_runner.ENTRY_TIME = time.time()
+        expect_runner.TIMEOUT = 60
+
+        writer = threading.Timer(0.2, os.write, (write_fd, b'SSH@MyHappyShell#'))
+        writer.start()
+        with mock.patch('expect_runner.expect_runner.time.sleep') as sleep:
+            self.assertEqual(handler._recv('SSH@MyHappyShell#'), 'SSH@MyHappyShell#')
+        writer.join()
+        sleep.assert_not_called()
+        self.assertEqual(handler._shell.recv_ready.call_count, 3)
+
+    def test_expect_spanning_long_output(self):
+        handler = expect_runner.SSHHandler.__new__(expect_runner.SSHHandler)
+        expect_runner.ConnectionHandler.__init__(handler)
+        handler._profile = expect_runner.TRANSFER_PROFILES['default']
+        handler._shell = mock.Mock()
+        handler._shell.recv_ready.return_value = True
+        handler._shell.recv_stderr_ready.return_value = False
+
+        expect_runner.ENTRY_TIME = time.time()
+        expect_runner.TIMEOUT = 60
+
+        chunks = [b'Building configuration...\n'] + [b'interface x\n' * 100] * 20 + \
+            [b'end\n', b'SW1#']
+        for expect in [r'(?s)Building configuration.*end\s+SW1#', r'^Building[^#]+#$']:
+            handler._shell.recv.side_effect = list(chunks)
+            self.assertEqual(handler._recv(expect), b''.join(chunks).decode('utf-8'))
+
+        self.assertIsNone(expect_runner._get_expect_width(r'SSH@\S+#'))
+        self.assertIsNone(expect_runner._get_expect_width(r'#(?=\s*$)'))
+        self.assertEqual(expect_runner._get_expect_width(r'(?<=x)SSH@MyHappyShell#$'), 17)
+
+    def test_unknown_transfer_profile(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['transfer_profile'] = 'warp'
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+        self.assertEqual(status, LIVEACTION_STATUS_FAILED)
+        self.assertEqual(output['error'],
+                         'Unknown transfer profile "warp". Valid profiles are: bulk, default')
+
+    def test_pty_handler(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['cmds'] = MULTIPLE_COMMANDS
+        runner.runner_parameters['handler'] = 'pty'
+        runner.runner_parameters['pty_command'] = [sys.executable, '-c', MOCK_CLI]
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        # Terminal echoes the commands back
+        self.assertEqual(output['init_output'], 'enable\nenable: done\nSSH@MyHappyShell#')
+        self.assertEqual(output['result'],
+                         'one happy command\none happy command: done\nSSH@MyHappyShell#'
+                         'two happy commands\ntwo happy commands: done\nSSH@MyHappyShell#')
+        self.assertFalse(runner._shell.is_alive())
+
+    def test_pty_command_with_braces(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['handler'] = 'pty'
+        runner.runner_parameters['port'] = 2222
+        runner.runner_parameters['pty_command'] = [sys.executable, '-c', MOCK_CLI, '{print $1}',
+                                                   '{username}@{host}:{port}']
+        runner.pre_run()
+
+        with mock.patch('expect_runner.expect_runner.subprocess.Popen',
+                        wraps=subprocess.Popen) as popen:
+            (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(popen.call_args[0][0][-2:], ['{print $1}', 'emma@10.4.2.1:2222'])
+
+    def test_pty_handler_password_prompt_after_warning(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['handler'] = 'pty'
+        runner.runner_parameters['pty_command'] = [sys.executable, '-c', MOCK_CLI_WITH_WARNING]
+        runner.runner_parameters['timeout'] = 10
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(output['init_output'], 'enable\nenable: done\nSSH@MyHappyShell#')
+        self.assertEqual(output['result'],
+                         'one happy command\none happy command: done\nSSH@MyHappyShell#')
+
+    @mock.patch('expect_runner.expect_runner.SLEEP_TIMER', 1)
+    def test_pty_handler_timeout(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['cmds'] = [['one happy command', 'never printed']]
+        runner.runner_parameters['handler'] = 'pty'
+        runner.runner_parameters['pty_command'] = [sys.executable, '-c', MOCK_CLI]
+        runner.runner_parameters['timeout'] = 1
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_TIMED_OUT)
+        self.assertEqual(output['checkpoint']['outputs'], [[]])
+        self.assertFalse(runner._shell.is_alive())
+
+    def test_pty_handler_command_exits(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['password'] = 'wrong'
+        runner.runner_parameters['handler'] = 'pty'
+        runner.runner_parameters['pty_command'] = [sys.executable, '-c', MOCK_CLI]
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_FAILED)
+        self.assertTrue(output['error'].startswith('Command exited before expect "#" matched'))
+
+    def test_exec_mode(self):
+        ssh_client = MockParamiko.SSHClient()
+        shell = ssh_client.invoke_shell()
+        MockParamiko.reset_mock()
+
+        channels = []
+
+        def open_session():
+            channels.append(MockExecChannel())
+            return channels[-1]
+
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['cmds'] = ['uname -a', ['missing', '#'], {'cmd': 'uptime'}]
+        runner.runner_parameters['ssh_mode'] = 'exec'
+        runner.runner_parameters['exec_concurrency'] = 2
+        runner.pre_run()
+
+        with mock.patch.object(ssh_client.get_transport(), 'open_session', open_session):
+            (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(output['result'], u'uname -a: done\n\u0153\nuptime: done\n\u0153\n')
+        self.assertEqual(output['init_output'], '')
+        self.assertEqual(output['commands'], [
+            {'cmd': 'uname -a', 'stdout': u'uname -a: done\n\u0153\n', 'stderr': '',
+             'exit_code': 0},
+            {'cmd': 'missing', 'stdout': '', 'stderr': 'command not found\n', 'exit_code': 127},
+            {'cmd': 'uptime', 'stdout': u'uptime: done\n\u0153\n', 'stderr': '',
+             'exit_code': 0}
+        ])
+
+        self.assertEqual([channel.cmd for channel in channels], ['uname -a', 'missing', 'uptime'])
+        self.assertTrue(all(channel.closed for channel in channels))
+        # No interactive shell, init_cmds are not sent
+        self.assertEqual(shell.send.call_count, 0)
+
+    def test_exec_mode_output_with_eof(self):
+        ssh_client = MockParamiko.SSHClient()
+        MockParamiko.reset_mock()
+
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['cmds'] = ['cat log']
+        runner.runner_parameters['ssh_mode'] = 'exec'
+        runner.pre_run()
+
+        with mock.patch.object(ssh_client.get_transport(), 'open_session', RacyExecChannel):
+            (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(output['commands'][0]['stdout'], 'part1 LAST-CHUNK\n')
+
+    def test_exec_mode_close_without_eof(self):
+        ssh_client = MockParamiko.SSHClient()
+        MockParamiko.reset_mock()
+
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['cmds'] = ['ls']
+        runner.runner_parameters['ssh_mode'] = 'exec'
+        runner.runner_parameters['timeout'] = 5
+        runner.pre_run()
+
+        with mock.patch.object(ssh_client.get_transport(), 'open_session', ClosingExecChannel):
+            (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(output['commands'], [
+            {'cmd': 'ls', 'stdout': 'file1\nfile2\n', 'stderr': '', 'exit_code': -1}
+        ])
+
+    @mock.patch('expect_runner.expect_runner.SLEEP_TIMER', 0.01)
+    def test_exec_mode_resume_from_checkpoint(self):
+        ssh_client = MockParamiko.SSHClient()
+        MockParamiko.reset_mock()
+        HangingExecChannel.hanging_commands = ['show tech']
+        HangingExecChannel.commands = []
+
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['cmds'] = ['uname -a', 'show tech']
+        runner.runner_parameters['ssh_mode'] = 'exec'
+        runner.runner_parameters['timeout'] = 0.3
+        runner.pre_run()
+
+        with mock.patch.object(ssh_client.get_transport(), 'open_session', HangingExecChannel):
+            (status, output, _) = runner.run(None)
+
+        uname_result = {'cmd': 'uname -a', 'stdout': u'uname -a: done\n\u0153\n', 'stderr': '',
+                        'exit_code': 0}
+
+        self.assertEqual(status, LIVEACTION_STATUS_TIMED_OUT)
+        self.assertEqual(output['result'], None)
+        self.assertEqual(output['exit_code'], -9)
+        self.assertEqual(output['partial_output'], u'uname -a: done\n\u0153\nstill running\n')
+        self.assertEqual(output['commands'], [
+            uname_result,
+            {'cmd': 'show tech', 'stdout': 'still running\n', 'stderr': '', 'exit_code': None}
+        ])
+        # Only finished commands are part of the checkpoint
+        checkpoint = json.loads(json.dumps(output['checkpoint']))
+        self.assertEqual(checkpoint['commands'], [uname_result, None])
+
+        HangingExecChannel.hanging_commands = []
+        HangingExecChannel.commands = []
+        runner.runner_parameters['timeout'] = 60
+        runner.runner_parameters['resume_from'] = checkpoint
+        runner.pre_run()
+
+        with mock.patch.object(ssh_client.get_transport(), 'open_session', HangingExecChannel):
+            (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(HangingExecChannel.commands, ['show tech'])
+        self.assertEqual(output['result'],
+                         u'uname -a: done\n\u0153\nshow tech: done\n\u0153\n')
+        self.assertEqual(output['commands'][0], uname_result)
+
+        # Checkpoints of interactive executions don't apply to exec mode
+        runner.runner_parameters['ssh_mode'] = 'shell'
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+        self.assertEqual(status, LIVEACTION_STATUS_FAILED)
+
+    def test_exec_mode_requires_commands(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['cmds'] = NONE_COMMANDS
+        runner.runner_parameters['ssh_mode'] = 'exec'
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_FAILED)
+        self.assertTrue(output['error'].startswith('Every entry needs a command in exec mode'))
+
     def _get_mock_action_obj(self):
         """
         Return mock action object.
@@ -343,8 +1158,200 @@ class ExpectRunnerTestCase(RunnerTestCase):
         self.assertTrue(output is not None)
         self.assertEqual(output['error'], 'Expect and command cannot both be NoneType.')
 
+    def test_cmds_are_not_modified(self):
+        runner = get_runner()
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        cmds = copy.deepcopy(MULTIPLE_COMMANDS)
+        runner.runner_parameters['cmds'] = cmds
+        runner.pre_run()
+        runner.run(None)
+        self.assertEqual(cmds, MULTIPLE_COMMANDS)
+
+        (status, output, _) = runner.run(None)
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(output['result'], MOCK_OUTPUT * 2)
+
+    def test_compile_plan(self):
+        plan = expect_runner.compile_plan(MULTIPLE_COMMANDS_DICT_ITEMS + NONE_COMMANDS, '>')
+        self.assertEqual(len(plan), 3)
+        self.assertEqual([step.cmd for step in plan.steps],
+                         ['one happy command', 'two happy command', None])
+        self.assertEqual([step.expect.pattern for step in plan.steps], ['>', '#', '#'])
+        self.assertRaises(AttributeError, setattr, plan.steps[0], 'cmd', 'reboot')
+
+        # Plans are cached by content
+        self.assertIs(expect_runner.compile_plan(copy.deepcopy(MULTIPLE_COMMANDS_DICT_ITEMS +
+                                                               NONE_COMMANDS), '>'), plan)
+        self.assertIsNot(expect_runner.compile_plan(MULTIPLE_COMMANDS_DICT_ITEMS + NONE_COMMANDS,
+                                                    '#'), plan)
+
+        self.assertRaises(ValueError, expect_runner.compile_plan, NONE_EXPECT_COMMANDS)
+        self.assertRaises(ValueError, expect_runner.compile_plan, [['a', 'b', 'c']])
+
+    def test_persistent_session(self):
+        expect_runner._SESSION_POOL.clear()
+        self.addCleanup(expect_runner._SESSION_POOL.clear)
+
+        ssh_client = MockParamiko.SSHClient()
+        shell = ssh_client.invoke_shell()
+        MockParamiko.reset_mock()
+
+        with mock.patch.object(shell, 'closed', False):
+            for _ in range(3):
+                runner = get_runner()
+                runner.action = self._get_mock_action_obj()
+                runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+                runner.runner_parameters['grammar'] = None
+                runner.runner_parameters['persistent_session'] = True
+                runner.pre_run()
+                (status, output, _) = runner.run(None)
+                self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+                self.assertEqual(output['result'], MOCK_OUTPUT)
+                self.assertEqual(output['init_output'], MOCK_OUTPUT)
+
+        # Connected and initialized only once, session kept open
+        self.assertEqual(ssh_client.connect.call_count, 1)
+        self.assertEqual(shell.send.call_args_list.count(mock.call('enable\n')), 1)
+        self.assertEqual(shell.send.call_args_list.count(mock.call('one happy command\n')), 3)
+        self.assertEqual(ssh_client.close.call_count, 0)
+        self.assertEqual(len(expect_runner._SESSION_POOL), 1)
+
+    def test_persistent_session_handler_options(self):
+        expect_runner._SESSION_POOL.clear()
+        self.addCleanup(expect_runner._SESSION_POOL.clear)
+
+        ssh_client = MockParamiko.SSHClient()
+        shell = ssh_client.invoke_shell()
+        MockParamiko.reset_mock()
+
+        options = [
+            {},
+            {'port': 2222},
+            {'transfer_profile': 'bulk'},
+            {'compress': True},
+            {'ssh_mode': 'exec'},
+            {'port': 2222}
+        ]
+
+        with mock.patch.object(shell, 'closed', False):
+            for parameters in options:
+                runner = get_runner()
+                runner.action = self._get_mock_action_obj()
+                runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+                runner.runner_parameters['grammar'] = None
+                runner.runner_parameters['persistent_session'] = True
+                runner.runner_parameters.update(parameters)
+                runner.pre_run()
+                runner._shell = runner._open_shell()
+                runner._release_shell()
+
+        # Sessions are only reused with the same handler options
+        self.assertEqual(ssh_client.connect.call_count, 5)
+        self.assertEqual(len(expect_runner._SESSION_POOL), 5)
+
+    def test_persistent_pty_session_command(self):
+        expect_runner._SESSION_POOL.clear()
+        self.addCleanup(expect_runner._SESSION_POOL.clear)
+
+        outputs = []
+        for cli in ['cli-A', 'cli-B']:
+            runner = get_runner()
+            runner.action = self._get_mock_action_obj()
+            runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+            runner.runner_parameters['grammar'] = None
+            runner.runner_parameters['cmds'] = ['who']
+            runner.runner_parameters['handler'] = 'pty'
+            runner.runner_parameters['pty_command'] = [sys.executable, '-c',
+                                                       MOCK_CLI.replace('done', cli)]
+            runner.runner_parameters['persistent_session'] = True
+            runner.pre_run()
+            (status, output, _) = runner.run(None)
+            self.addCleanup(runner._shell.terminate)
+
+            self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+            outputs.append(output['result'])
+
+        self.assertEqual(outputs, ['who\nwho: cli-A\nSSH@MyHappyShell#',
+                                   'who\nwho: cli-B\nSSH@MyHappyShell#'])
+
+    @mock.patch('expect_runner.expect_runner._SESSION_REAPER', None)
+    @mock.patch('expect_runner.expect_runner.SESSION_POOL_REAP_INTERVAL', 0.05)
+    def test_session_pool_reaper(self):
+        expect_runner._SESSION_POOL.clear()
+        self.addCleanup(expect_runner._SESSION_POOL.clear)
+
+        session = expect_runner.ConnectionHandler()
+        session.terminate = mock.Mock()
+        expect_runner._checkin_session('key', session, 0.1)
+
+        # Expired without any other execution checking out a session
+        for _ in range(40):
+            if session.terminate.called:
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(session.terminate.call_count, 1)
+        self.assertEqual(expect_runner._SESSION_POOL, {})
+
+    @mock.patch('expect_runner.expect_runner.SESSION_POOL_SIZE', 2)
+    def test_session_pool_size(self):
+        expect_runner._SESSION_POOL.clear()
+        self.addCleanup(expect_runner._SESSION_POOL.clear)
+
+        sessions = []
+        for _ in range(3):
+            session = expect_runner.ConnectionHandler()
+            session.terminate = mock.Mock()
+            expect_runner._checkin_session('key', session, 60)
+            sessions.append(session)
+
+        # Oldest session is terminated
+        self.assertEqual(expect_runner._SESSION_POOL['key'], sessions[1:])
+        self.assertEqual([s.terminate.call_count for s in sessions], [1, 0, 0])
+
+    def test_persistent_session_dead_session_is_replaced(self):
+        expect_runner._SESSION_POOL.clear()
+        self.addCleanup(expect_runner._SESSION_POOL.clear)
+
+        ssh_client = MockParamiko.SSHClient()
+        MockParamiko.reset_mock()
+
+        for _ in range(2):
+            runner = get_runner()
+            runner.action = self._get_mock_action_obj()
+            runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+            runner.runner_parameters['persistent_session'] = True
+            runner.pre_run()
+            (status, _, _) = runner.run(None)
+            self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+
+        # Mock shell reports it's closed so the pooled session is thrown away
+        self.assertEqual(ssh_client.connect.call_count, 2)
+        self.assertEqual(ssh_client.close.call_count, 1)
+
+    def test_privilege_password(self):
+        config = copy.deepcopy(MOCK_CONFIG)
+        config['privilege_expect'] = 'SSH@MyHappyShell>'
+        runner = get_runner(config=config)
+        runner.action = self._get_mock_action_obj()
+        runner.runner_parameters = copy.deepcopy(RUNNER_PARAMETERS)
+        runner.runner_parameters['grammar'] = None
+        runner.runner_parameters['privilege_password'] = 'secret'
+        runner.pre_run()
+        (status, output, _) = runner.run(None)
+
+        self.assertEqual(status, LIVEACTION_STATUS_SUCCEEDED)
+        self.assertEqual(output['init_output'], MOCK_OUTPUT * 3)
+        self.assertTrue(runner._shell.state.privileged)
+
+        shell = MockParamiko.SSHClient().invoke_shell()
+        shell.send.assert_any_call('enable\n')
+        shell.send.assert_any_call('secret\n')
+
     def test_unicode_response(self):
         MockUnicodeParamiko = mock.MagicMock()
+        MockUnicodeParamiko.SSHClient().invoke_shell().fileno.return_value = READABLE_FD
         MockUnicodeParamiko.SSHClient().invoke_shell().recv_ready.side_effect = \
             lambda: (MockParamiko.SSHClient().invoke_shell().recv_ready.call_count % 2) == 0
         MockUnicodeParamiko.SSHClient().invoke_shell().recv_stderr_ready.side_effect = \